@@ -1,12 +1,16 @@
-from flask import Flask, render_template, request, redirect, url_for 
-import numpy as np
-import pandas as pd 
+from flask import Flask, render_template, request, redirect, url_for, g, before_render_template, template_rendered
 import os
-import torch
-from torchvision import transforms
+import logging
+import time
 from dataset_maker import preprocess
-from PIL import Image
-from resnet import resnet14, resnet18, resnet34, resnet50
+from resnet import resnet18
+from model_registry import ModelRegistry
+from catalogue import SERVING_COLUMNS
+from recipe_store import RecipeStore, RECIPES_CSV
+from inference import classify_uploads, MAX_BATCH_SIZE as DEFAULT_MAX_BATCH_SIZE
+from prediction_cache import PredictionCache
+from inference_server import InferenceScheduler, QueueFullError
+from instrumentation import MetricsRegistry, StageTimer, SamplingProfiler, configure_logging, CONTENT_TYPE
 
 import io
 import base64
@@ -14,6 +18,104 @@ import base64
 ### stuff from last class
 app = Flask(__name__)
 
+# key=value log lines on stderr, LOG_LEVEL=DEBUG also logs the recipes found per request
+configure_logging(os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger('app')
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CLASSES = ['beans', 'bell_pepper', 'potato', 'tomato']
+# uploads larger than this are classified in several forward passes
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', DEFAULT_MAX_BATCH_SIZE))
+
+MODEL_LOGS = os.path.join(APP_DIR, 'model', 'model_logs')
+# INGREDIENT_MODEL picks which artifact is served: the eager checkpoint, the
+# frozen TorchScript export written by model_export.py, or the INT8 model
+# written by quantize.py
+MODEL_NAME = os.environ.get('INGREDIENT_MODEL', 'eager')
+
+# models are loaded once per worker and shared by all request threads
+registry = ModelRegistry()
+registry.register('eager',
+                  os.path.join(MODEL_LOGS, 'Ingredients8.pth'),
+                  lambda: resnet18(len(CLASSES), 3)) # model trained on small dataset
+registry.register('scripted', os.path.join(MODEL_LOGS, 'Ingredients8.scripted.pt'))
+registry.register('int8', os.path.join(MODEL_LOGS, 'Ingredients8.int8.pt'))
+if os.environ.get('PRELOAD_MODELS') == '1':
+    registry.get(MODEL_NAME)
+
+# concurrent requests share forward passes run by one background worker,
+# set MICRO_BATCHING=0 to have each request thread call the model itself
+scheduler = None
+if os.environ.get('MICRO_BATCHING', '1') == '1':
+    scheduler = InferenceScheduler(lambda: registry.get(MODEL_NAME).model,
+                                   float(os.environ.get('MICRO_BATCH_WAIT_MS', 5)),
+                                   MAX_BATCH_SIZE,
+                                   int(os.environ.get('MICRO_BATCH_MAX_QUEUE', 64)))
+
+# predictions for repeated uploads, dropped whenever the checkpoint changes
+prediction_cache = PredictionCache(int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)),
+                                   float(os.environ.get('PREDICTION_CACHE_TTL', 3600)))
+
+# recipes are parsed once per worker, from the prebuilt columnar snapshot if there is one,
+# without the full ingredient text the pages never show
+recipe_store = RecipeStore(RECIPES_CSV, os.path.splitext(RECIPES_CSV)[0] + '.npz', SERVING_COLUMNS)
+
+# request and stage timings, exposed in the Prometheus text format at /metrics
+metrics = MetricsRegistry()
+request_counter = metrics.counter('http_requests_total', 'Requests handled, by endpoint, method and status.',
+                                  ('endpoint', 'method', 'status'))
+request_seconds = metrics.histogram('http_request_duration_seconds', 'Time to handle a request, by endpoint.',
+                                    ('endpoint',))
+stage_seconds = metrics.histogram('request_stage_duration_seconds',
+                                  'Time spent in each stage of a request: upload_read, decode, preprocess, '
+                                  'forward, recipe_lookup and render.', ('stage',))
+upload_counter = metrics.counter('uploaded_images_total', 'Uploaded images, by outcome.', ('outcome',))
+
+# with PROFILE_DIR set, a request with ?profile=1 or an X-Profile: 1 header is
+# sampled and its collapsed stacks are written to that folder
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
+@app.before_request
+def start_request():
+    g.start = time.perf_counter()
+    g.timer = StageTimer(stage_seconds)
+    g.profiler = None
+    if PROFILE_DIR and (request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'):
+        g.profiler = SamplingProfiler()
+        g.profiler.start()
+
+@app.after_request
+def finish_request(response):
+    elapsed = time.perf_counter() - g.start
+    endpoint = request.endpoint or 'unknown'
+    request_counter.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    request_seconds.observe(elapsed, endpoint=endpoint)
+    fields = {'endpoint': endpoint, 'method': request.method, 'status': response.status_code,
+              'duration_ms': round(elapsed * 1000.0, 3)}
+    fields.update({f'{stage}_ms': ms for stage, ms in g.timer.durations_ms().items()})
+    if g.profiler is not None:
+        samples = g.profiler.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile_path = os.path.join(PROFILE_DIR, f'{endpoint}-{time.time_ns()}.collapsed')
+        g.profiler.write(profile_path)
+        response.headers['X-Profile-File'] = profile_path
+        fields.update(profile=profile_path, profile_samples=samples)
+    logger.info('request', extra={'fields': fields})
+    return response
+
+@before_render_template.connect_via(app)
+def start_render(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def finish_render(sender, template, context, **extra):
+    if 'timer' in g:
+        g.timer.record('render', time.perf_counter() - g.render_start)
+
+@app.route('/metrics')
+def metrics_page():
+    return metrics.render(), 200, {'Content-Type': CONTENT_TYPE}
+
 @app.route('/')
 def main():
     return render_template('main_better.html')
@@ -34,51 +136,35 @@ def generate():
     else:
         try:
             cuisine = request.form.get('cuisine')
-            classes = ['beans', 'bell_pepper', 'potato', 'tomato']
-            model = resnet18(4, 3) # model trained on small dataset
-            model.load_state_dict(torch.load('model/model_logs/Ingredients8.pth', map_location='cpu'))
-
-            #set to eval for testing
-            model.eval()
+            classes = CLASSES
+            # already in eval mode, reloaded only if the checkpoint changed
+            loaded = registry.get(MODEL_NAME)
             files = request.files.getlist('images[]')
-            transform = transforms.Compose([
-                transforms.RandomHorizontalFlip(),
-                transforms.RandomResizedCrop(32),
-                transforms.ToTensor(),
-                transforms.Normalize((0.38046584, 0.10854615, -0.13485776), (0.5249659, 0.59474176, 0.6634378))
-            ])  
-            ingredients = []
-            images = []
-            for file in files:
-                try:
-                    image = Image.open(file)
-                    if image is not None:
-                        if image.mode != 'RGB':
-                            image = image.convert('RGB')
-                        # image = image.resize((150,150))
-                        image = np.array(image)
-                        images.append(image)
-                except Exception as e:
-                    print(f'Error reading file {file}: {e}')
-
-            # allow for the transform to work on pil_image
-            pil_images = [Image.fromarray(image) for image in images]
-            transformed_images = [transform(image) for image in pil_images]
-            images = torch.stack(transformed_images)
-
-            # classify each image
-            for image in images:
-                # don't track gradient for efficient testing
-                with torch.no_grad():
-                    outputs = model(image.unsqueeze(0))
-                    _, pred_class = torch.max(outputs, 1)
-                    ingredient = classes[pred_class.item()]
-                    ingredients.append(ingredient)
+            with g.timer.stage('upload_read'):
+                uploads = [file.read() for file in files]
+
+            # repeated photos come from the cache, the rest are classified as one batch; the
+            # scheduler runs them on loaded.model, the checkpoint the predictions are cached under
+            model = scheduler.bind(loaded.model) if scheduler is not None else loaded.model
+            pred_classes, errors = classify_uploads(model, uploads, loaded.version,
+                                                    prediction_cache, MAX_BATCH_SIZE, g.timer)
+            upload_counter.inc(len(pred_classes), outcome='classified')
+            upload_counter.inc(len(errors), outcome='unreadable')
+            for i, e in errors:
+                logger.warning('unreadable upload', extra={'fields': {'filename': files[i].filename, 'error': e}})
+            if len(pred_classes) == 0:
+                return render_template('generate2.html', error=True)
+            ingredients = [classes[pred_class] for pred_class in pred_classes]
 
             # send list of ingredients to recipe_results function
             return redirect(url_for('recipe_results', cuisine=cuisine, ingredients=ingredients))
-        
+
+        except QueueFullError:
+            # too many uploads already waiting for the model, ask the client to back off
+            logger.warning('inference queue full')
+            return render_template('generate2.html', error=True), 503, {'Retry-After': '1'}
         except:
+            logger.exception('generate failed')
             return render_template('generate2.html', error=True)
 
 @app.route('/generate/<name>')
@@ -101,25 +187,17 @@ def gen_recipe(cuisine, list_of_ingredients=None):
   - Input: cuisine, list of ingredients
   - Output: dataframe of recomended recipes
   '''
-  link = 'https://raw.githubusercontent.com/Nkannan12/Project-16B-GNN/main/Recipes_cleaned.csv'
-  df = pd.read_csv(link)
-
   if list_of_ingredients == None:
-    cuisine_df = df[df["Cuisine"] == cuisine].copy()
+    cuisine_df = recipe_store.by_cuisine(cuisine)
     return cuisine_df
   else:
-    cuisine_df = df[df["Cuisine"] == cuisine].copy()
-    # Create a new column to count matching ingredients
-    cuisine_df['Matched Ingredients'] = cuisine_df['key_ingredients'].apply(lambda x: sum(1 for ingredient in list_of_ingredients if ingredient in x))
-    if len(list_of_ingredients) > 2:
-      cuisine_df = cuisine_df[cuisine_df['Matched Ingredients'] >= 2]
+    # the same ingredient detected in several photos only counts once
+    if len(set(list_of_ingredients)) > 2:
+      min_matches = 2
     else:
-      cuisine_df = cuisine_df[cuisine_df['Matched Ingredients'] >= 1]
-    # Sort dataframe based on the number of matched ingredients in descending order
-    cuisine_df = cuisine_df.sort_values(by='Matched Ingredients', ascending=False)
-
-    # Reset index
-    cuisine_df.reset_index(drop=True, inplace=True)
+      min_matches = 1
+    # scored against the inverted ingredient index, sorted from most to least matching
+    cuisine_df = recipe_store.recommend(cuisine, list_of_ingredients, min_matches=min_matches)
 
     return cuisine_df 
  
@@ -138,7 +216,8 @@ def filter_recipes():
     cuisine = request.form.get('cuisine')
     ingredients = None 
 
-    recommended_recipes = gen_recipe(cuisine, ingredients)
+    with g.timer.stage('recipe_lookup'):
+        recommended_recipes = gen_recipe(cuisine, ingredients)
     recipes_data = recommended_recipes.to_dict(orient='records')
     
     # Render the recipe_results.html template, passing the recipes data
@@ -161,15 +240,17 @@ def recipe_results():
     if request.method == 'GET':
         # fetch cuisine and ingredients passed form generate
         cuisine = request.args.get('cuisine')
-        ingredients = request.args.get('ingredients')
-        if cuisine is None or ingredients is None:
+        ingredients = request.args.getlist('ingredients')
+        if cuisine is None or not ingredients:
             message = "Provide both a cuisine and ingredients."
             return render_template('recipe_results.html', message=message)
         # print(cuisine + ' ' + ingredients)
-        recommended_recipes = gen_recipe(cuisine, ingredients)
+        with g.timer.stage('recipe_lookup'):
+            recommended_recipes = gen_recipe(cuisine, ingredients)
         # print(recommended_recipes)
         recipes_data = recommended_recipes.to_dict(orient='records')
-        print(recipes_data)  # Debugging line to check data
+        logger.debug('recipes found', extra={'fields': {'cuisine': cuisine, 'ingredients': ','.join(ingredients),
+                                                        'recipes': len(recipes_data)}})
         return render_template('recipe_results.html', recipes=recipes_data)
     else:
         message = "Please select a cuisine to view recipes."
@@ -0,0 +1,323 @@
+"""Latency and throughput benchmarks of the training and serving hot paths.
+
+Every case is timed over a number of repeats after a warmup, and reported as
+p50/p95/p99 latency in milliseconds plus throughput in items per second. The
+suites are:
+
+- forward: ResNet forward passes at several batch sizes and thread counts
+- flask: end-to-end test client requests to ``/generate/`` and ``/recipe_results/``
+- recipes: ``gen_recipe`` on catalogues of several sizes, resampled from the shipped CSV
+- loading: ``load_images_and_labels`` on a synthetic tree of JPEGs
+
+Results are written as JSON together with the git commit they were measured
+on, and ``--compare`` prints the p50 change against an earlier result file.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --suites forward recipes --compare bench.json --output bench_new.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+
+from dataset_maker import CLASS_MAPPING, load_images_and_labels
+from model_export import ARCHITECTURES
+from recipe_store import RECIPES_CSV, RecipeStore
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+SUITES = ('forward', 'flask', 'recipes', 'loading')
+
+
+def summarize(latencies, items_per_call=1):
+    """Reduces the timings of one case to percentiles and throughput.
+
+    Args:
+        latencies (list): Seconds taken by each call.
+        items_per_call (int): Images, requests or recipes handled by one call.
+
+    Returns:
+        dict: p50, p95, p99 and mean latency in ms, calls and throughput in items/sec.
+    """
+    latencies_ms = np.asarray(latencies) * 1000.0
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'mean_ms': float(latencies_ms.mean()),
+        'calls': len(latencies_ms),
+        'throughput': float(items_per_call * len(latencies_ms) / (latencies_ms.sum() / 1000.0)),
+    }
+
+
+def time_calls(fn, repeat=20, warmup=3):
+    """Times repeated calls of fn.
+
+    Args:
+        fn (callable): Called with the index of the call, from 0 to warmup + repeat - 1.
+        repeat (int): Number of timed calls.
+        warmup (int): Number of untimed calls made first.
+
+    Returns:
+        list: Seconds taken by each timed call.
+    """
+    for i in range(warmup):
+        fn(i)
+    latencies = []
+    for i in range(warmup, warmup + repeat):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def jpeg_bytes(seed, size=(256, 256)):
+    """Encodes a random RGB image as JPEG.
+
+    Args:
+        seed (int): Seed of the pixel values, different seeds give different files.
+        size (tuple): (width, height) of the image.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    pixels = np.random.RandomState(seed).randint(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def bench_forward(archs=('resnet18', 'resnet34', 'resnet50'), batch_sizes=(1, 8, 32), thread_counts=(1, None),
+                  repeat=20, size=32, num_classes=4):
+    """Times ResNet forward passes.
+
+    Args:
+        archs (tuple): Names of the architectures, keys of ``model_export.ARCHITECTURES``.
+        batch_sizes (tuple): Numbers of images per forward pass.
+        thread_counts (tuple): Intra-op thread counts, None for the default (all cores).
+        repeat (int): Number of timed passes per case.
+        size (int): Side length of the input images.
+        num_classes (int): Number of output classes.
+
+    Returns:
+        dict: Summary of every case, by 'arch/batch=N/threads=T'.
+    """
+    default_threads = torch.get_num_threads()
+    results = {}
+    try:
+        for arch in archs:
+            model = ARCHITECTURES[arch](num_classes, 3).eval()
+            # None and an explicit count can resolve to the same number, which would collide in results
+            for threads in dict.fromkeys(threads or default_threads for threads in thread_counts):
+                torch.set_num_threads(threads)
+                for batch_size in batch_sizes:
+                    images = torch.randn(batch_size, 3, size, size)
+
+                    def forward(_):
+                        with torch.inference_mode():
+                            model(images)
+
+                    name = f'{arch}/batch={batch_size}/threads={threads}'
+                    results[name] = summarize(time_calls(forward, repeat), batch_size)
+    finally:
+        torch.set_num_threads(default_threads)
+    return results
+
+
+def bench_flask(repeat=20, images_per_request=(1, 4)):
+    """Times end-to-end requests through the Flask test client.
+
+    The served model is swapped for a randomly initialized resnet18 saved to a
+    temporary file, so no trained checkpoint is needed. Every request uploads
+    different images so the prediction cache never answers it.
+
+    Args:
+        repeat (int): Number of timed requests per case.
+        images_per_request (tuple): Numbers of images uploaded to /generate/.
+
+    Returns:
+        dict: Summary of every case, by route and number of images.
+    """
+    import app as webapp
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = os.path.join(tmp, 'random.pth')
+        builder = lambda: ARCHITECTURES['resnet18'](len(webapp.CLASSES), 3)
+        torch.save(builder().state_dict(), checkpoint)
+        webapp.registry.register(webapp.MODEL_NAME, checkpoint, builder)
+        client = webapp.app.test_client()
+        cuisine = webapp.recipe_store.cuisines()[0]
+
+        for count in images_per_request:
+            def generate(i):
+                files = [(io.BytesIO(jpeg_bytes(i * count + j)), f'{j}.jpg') for j in range(count)]
+                response = client.post('/generate/', data={'cuisine': cuisine, 'images[]': files},
+                                       content_type='multipart/form-data')
+                assert response.status_code == 302, f'/generate/ returned {response.status_code}'
+
+            results[f'generate/images={count}'] = summarize(time_calls(generate, repeat), count)
+
+        query = {'cuisine': cuisine, 'ingredients': list(webapp.CLASSES)}
+
+        def recipe_results(_):
+            response = client.get('/recipe_results/', query_string=query)
+            assert response.status_code == 200, f'/recipe_results/ returned {response.status_code}'
+
+        results['recipe_results'] = summarize(time_calls(recipe_results, repeat))
+        if webapp.scheduler is not None:
+            webapp.scheduler.close()
+    return results
+
+
+def bench_recipes(catalogue_sizes=(2000, 20000, 200000), repeat=20):
+    """Times ``gen_recipe`` on catalogues resampled from the shipped recipes.
+
+    Args:
+        catalogue_sizes (tuple): Total numbers of recipes in the catalogue.
+        repeat (int): Number of timed calls per case.
+
+    Returns:
+        dict: Summary of every case, by catalogue size.
+    """
+    import app as webapp
+
+    recipes = pd.read_csv(RECIPES_CSV)
+    cuisine = recipes['Cuisine'].value_counts().index[0]
+    ingredients = ['tomato', 'potato', 'bell_pepper', 'beans']
+    results = {}
+    original_store = webapp.recipe_store
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for catalogue_size in catalogue_sizes:
+                path = os.path.join(tmp, f'recipes_{catalogue_size}.csv')
+                recipes.sample(catalogue_size, replace=True, random_state=0).to_csv(path, index=False)
+                webapp.recipe_store = RecipeStore(path)
+                results[f'gen_recipe/recipes={catalogue_size}'] = summarize(
+                    time_calls(lambda _: webapp.gen_recipe(cuisine, ingredients), repeat))
+    finally:
+        webapp.recipe_store = original_store
+    return results
+
+
+def bench_loading(images_per_class=(25, 100), worker_counts=(1, None), repeat=3, image_size=(320, 240)):
+    """Times ``load_images_and_labels`` on a synthetic tree of JPEGs.
+
+    Args:
+        images_per_class (tuple): Numbers of images written to every class folder.
+        worker_counts (tuple): Decoding processes, None for all cores.
+        repeat (int): Number of timed loads per case.
+        image_size (tuple): (width, height) of the synthetic images.
+
+    Returns:
+        dict: Summary of every case in images per second, by tree size and workers.
+    """
+    results = {}
+    for count in images_per_class:
+        with tempfile.TemporaryDirectory() as tmp:
+            for class_name in CLASS_MAPPING:
+                os.makedirs(os.path.join(tmp, class_name))
+                for i in range(count):
+                    with open(os.path.join(tmp, class_name, f'{i}.jpg'), 'wb') as f:
+                        f.write(jpeg_bytes(i, image_size))
+            total = count * len(CLASS_MAPPING)
+            for workers in dict.fromkeys(workers or os.cpu_count() or 1 for workers in worker_counts):
+                latencies = time_calls(lambda _: load_images_and_labels(tmp, num_workers=workers), repeat, warmup=1)
+                results[f'load_images/images={total}/workers={workers}'] = summarize(latencies, total)
+    return results
+
+
+def environment():
+    """Describes what the benchmarks ran on.
+
+    Returns:
+        dict: Git commit, library versions, CPU count and time of the run.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def run(suites=SUITES, repeat=20):
+    """Runs the selected suites.
+
+    Args:
+        suites (tuple): Names of the suites to run, see SUITES.
+        repeat (int): Number of timed calls per case (the loading suite uses a fifth of it).
+
+    Returns:
+        dict: 'environment' and the results of every suite, by suite name.
+    """
+    runners = {
+        'forward': lambda: bench_forward(repeat=repeat),
+        'flask': lambda: bench_flask(repeat=repeat),
+        'recipes': lambda: bench_recipes(repeat=repeat),
+        'loading': lambda: bench_loading(repeat=max(1, repeat // 5)),
+    }
+    results = {'environment': environment()}
+    for suite in suites:
+        results[suite] = runners[suite]()
+    return results
+
+
+def compare(baseline, current):
+    """Lists the p50 latency change of every case measured in both result sets.
+
+    Args:
+        baseline (dict): Earlier results, as written by this script.
+        current (dict): New results.
+
+    Returns:
+        list: (suite, case, baseline p50 ms, current p50 ms, ratio) tuples.
+    """
+    rows = []
+    for suite in SUITES:
+        for case, stats in current.get(suite, {}).items():
+            old = baseline.get(suite, {}).get(case)
+            if old is not None:
+                rows.append((suite, case, old['p50_ms'], stats['p50_ms'], stats['p50_ms'] / old['p50_ms']))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the model, web app, recipe lookup and image loading.')
+    parser.add_argument('--suites', nargs='+', default=list(SUITES), choices=SUITES)
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per case')
+    parser.add_argument('--output', default='benchmark.json', help='path to write the JSON results to')
+    parser.add_argument('--compare', help='earlier results to compare against')
+    args = parser.parse_args()
+
+    results = run(args.suites, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for suite in args.suites:
+        for case, stats in results[suite].items():
+            print(f"{suite:8} {case:45} p50 {stats['p50_ms']:9.2f} ms  p95 {stats['p95_ms']:9.2f} ms  "
+                  f"p99 {stats['p99_ms']:9.2f} ms  {stats['throughput']:10.1f}/s")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for suite, case, old, new, ratio in compare(baseline, results):
+            print(f'{suite:8} {case:45} p50 {old:9.2f} -> {new:9.2f} ms ({ratio:.2f}x)')
@@ -0,0 +1,245 @@
+"""Typed, columnar file format of the recipe catalogue.
+
+``Recipes_cleaned.csv`` keeps ``key_ingredients`` as the Python repr of a
+list, so every reader has to re-parse text. A catalogue file is a ``.npz``
+archive with one or more arrays per column instead:
+
+- text columns (``Name``, ``URL``, ``Ingredients``) are stored as one UTF-8
+  buffer plus the character offsets of every row
+- ``Cuisine`` is dictionary encoded, as integer codes into its categories
+- ``key_ingredients`` is an integer-ID column in CSR form: the ingredient IDs
+  of every recipe, concatenated, plus the offset of every recipe into them and
+  the vocabulary the IDs refer to
+
+``np.load`` only reads the arrays that are accessed, so a reader can project
+the columns it needs and never pay for the rest (the web app skips the long
+``Ingredients`` text). The recommendation index is built straight from the
+integer IDs without touching any strings.
+
+Usage:
+    python catalogue.py Recipes_cleaned.csv Recipes_cleaned.npz
+    python catalogue.py Recipes_cleaned.npz Recipes_export.csv --export-csv
+"""
+
+import argparse
+import ast
+import os
+
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+TEXT_COLUMNS = ('Name', 'URL', 'Ingredients')
+CATEGORY_COLUMNS = ('Cuisine',)
+LIST_COLUMNS = ('key_ingredients',)
+# what the web app renders and groups by
+SERVING_COLUMNS = ('Name', 'URL', 'Cuisine', 'key_ingredients')
+
+
+def parse_key_ingredients(value):
+    '''
+    - Parses the key ingredients of one recipe
+    - Input: list of key ingredients, or its string repr as stored in the CSV
+    - Output: list of key ingredients
+    '''
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    if not isinstance(value, str):
+        return []
+    return ast.literal_eval(value)
+
+
+def _encode_text(values):
+    """Packs strings into one UTF-8 buffer and their character offsets.
+
+    Args:
+        values (iterable): Strings, missing values are stored as empty strings.
+
+    Returns:
+        tuple: (uint8 buffer, int64 offsets of length len(values) + 1).
+    """
+    values = ['' if not isinstance(value, str) else value for value in values]
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in values], out=offsets[1:])
+    data = np.frombuffer(''.join(values).encode('utf-8'), dtype=np.uint8)
+    return data, offsets
+
+
+def _decode_text(data, offsets):
+    """Unpacks strings packed by _encode_text.
+
+    Args:
+        data (numpy.ndarray): The UTF-8 buffer.
+        offsets (numpy.ndarray): Character offsets of every string.
+
+    Returns:
+        list: The strings.
+    """
+    # decoding once and slicing by characters avoids a decode call per row
+    text = str(memoryview(data), 'utf-8')
+    bounds = offsets.tolist()
+    return [text[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _encode_lists(values):
+    """Converts lists of strings into CSR integer IDs over a shared vocabulary.
+
+    Args:
+        values (iterable): Lists of strings or their string repr.
+
+    Returns:
+        tuple: (int32 ids, int64 offsets, vocabulary array in ID order).
+    """
+    vocabulary = {}
+    ids = []
+    offsets = [0]
+    for value in values:
+        for item in parse_key_ingredients(value):
+            ids.append(vocabulary.setdefault(item, len(vocabulary)))
+        offsets.append(len(ids))
+    return (np.asarray(ids, dtype=np.int32), np.asarray(offsets, dtype=np.int64),
+            np.asarray(list(vocabulary), dtype=np.str_))
+
+
+def write_catalogue(df, path):
+    """Writes a recipe frame as a catalogue file.
+
+    The file is written next to its destination and moved into place, so a
+    reader never sees a partial catalogue.
+
+    Args:
+        df (pandas.DataFrame): Recipes with any of the Name, URL, Ingredients, Cuisine and key_ingredients columns.
+        path (str): Destination, should end in '.npz'.
+
+    Returns:
+        str: Path of the written catalogue.
+    """
+    arrays = {
+        '__version__': np.asarray(FORMAT_VERSION),
+        '__columns__': np.asarray(list(df.columns), dtype=np.str_),
+        '__rows__': np.asarray(len(df)),
+    }
+    for column in df.columns:
+        if column in CATEGORY_COLUMNS:
+            values = df[column].astype('category')
+            arrays[f'{column}.codes'] = values.cat.codes.to_numpy(dtype=np.int32)
+            arrays[f'{column}.categories'] = np.asarray(values.cat.categories, dtype=np.str_)
+        elif column in LIST_COLUMNS:
+            ids, offsets, vocabulary = _encode_lists(df[column])
+            arrays[f'{column}.ids'] = ids
+            arrays[f'{column}.offsets'] = offsets
+            arrays[f'{column}.vocabulary'] = vocabulary
+        elif column in TEXT_COLUMNS or df[column].dtype == object:
+            arrays[f'{column}.data'], arrays[f'{column}.offsets'] = _encode_text(df[column])
+        else:
+            arrays[f'{column}.values'] = df[column].to_numpy()
+
+    # np.savez appends '.npz' to names without it, keep the suffix on the temporary file
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    return path
+
+
+def catalogue_columns(path):
+    """Returns the columns stored in a catalogue file, in order.
+
+    Args:
+        path (str): Catalogue file.
+
+    Returns:
+        list: Column names.
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        return archive['__columns__'].tolist()
+
+
+def read_key_ingredient_ids(path, column='key_ingredients'):
+    """Reads an integer-ID list column without converting it to strings.
+
+    Args:
+        path (str): Catalogue file.
+        column (str): Name of the list column.
+
+    Returns:
+        tuple: (ids, offsets, vocabulary) where the IDs of row i are ids[offsets[i]:offsets[i + 1]].
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        return archive[f'{column}.ids'], archive[f'{column}.offsets'], archive[f'{column}.vocabulary'].tolist()
+
+
+def read_catalogue(path, columns=None):
+    """Reads a catalogue file into a frame, loading only the requested columns.
+
+    Cuisine comes back as a pandas Categorical and key_ingredients as lists of
+    strings that share one string object per vocabulary entry.
+
+    Args:
+        path (str): Catalogue file.
+        columns (iterable, optional): Columns to load, in the order given; all of them if None.
+
+    Returns:
+        pandas.DataFrame: The recipes.
+
+    Raises:
+        KeyError: If a requested column is not in the file.
+    """
+    with np.load(path, allow_pickle=False) as archive:
+        stored = archive['__columns__'].tolist()
+        if columns is None:
+            columns = stored
+        missing = [column for column in columns if column not in stored]
+        if missing:
+            raise KeyError(f'{path} has no column(s) {missing}, it stores {stored}')
+
+        data = {}
+        for column in columns:
+            if f'{column}.codes' in archive.files:
+                data[column] = pd.Categorical.from_codes(archive[f'{column}.codes'],
+                                                         archive[f'{column}.categories'].tolist())
+            elif f'{column}.ids' in archive.files:
+                vocabulary = archive[f'{column}.vocabulary'].tolist()
+                items = [vocabulary[i] for i in archive[f'{column}.ids'].tolist()]
+                bounds = archive[f'{column}.offsets'].tolist()
+                data[column] = [items[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+            elif f'{column}.data' in archive.files:
+                data[column] = _decode_text(archive[f'{column}.data'], archive[f'{column}.offsets'])
+            else:
+                data[column] = archive[f'{column}.values']
+        return pd.DataFrame(data, index=pd.RangeIndex(int(archive['__rows__'])), columns=list(columns))
+
+
+def export_csv(path, csv_path, columns=None):
+    """Writes a catalogue file back out in the layout of Recipes_cleaned.csv.
+
+    List columns are written as the repr of the list, as the scraper does,
+    so consumers of the CSV keep working.
+
+    Args:
+        path (str): Catalogue file.
+        csv_path (str): Destination CSV.
+        columns (iterable, optional): Columns to export, all of them if None.
+
+    Returns:
+        str: Path of the written CSV.
+    """
+    df = read_catalogue(path, columns)
+    for column in LIST_COLUMNS:
+        if column in df:
+            df[column] = df[column].map(repr)
+    df.to_csv(csv_path, index=False)
+    return csv_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the recipe catalogue between CSV and the columnar format.')
+    parser.add_argument('source', help='CSV to convert, or catalogue file with --export-csv')
+    parser.add_argument('destination', help='catalogue file to write, or CSV with --export-csv')
+    parser.add_argument('--export-csv', action='store_true', help='export a catalogue file as CSV')
+    parser.add_argument('--columns', nargs='+', help='columns to keep, all of them by default')
+    args = parser.parse_args()
+
+    if args.export_csv:
+        print(f'Wrote {export_csv(args.source, args.destination, args.columns)}')
+    else:
+        print(f'Wrote {write_catalogue(pd.read_csv(args.source, usecols=args.columns), args.destination)}')
@@ -0,0 +1,482 @@
+"""Concurrent, polite HTTP fetching for the scrapers.
+
+A ``Crawler`` runs GET requests on a bounded thread pool that shares one
+keep-alive ``requests.Session``. Every host gets its own concurrency limit and
+minimum interval between requests, failed requests (connection errors,
+timeouts, 429 and 5xx responses) are retried with exponential backoff, and
+every request has a connect and read timeout.
+
+For incremental crawls, a ``PageCache`` keeps fetched pages on disk and turns
+refetches into conditional requests (If-None-Match / If-Modified-Since), so
+unchanged pages cost a 304 instead of a download. ``JsonlSink`` appends
+records to a file as they are scraped and ``VisitedCheckpoint`` remembers
+which URLs are done, so an interrupted crawl resumes where it stopped.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+# responses worth retrying, everything else is returned to the caller
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+USER_AGENT = 'Mozilla/5.0 (compatible; recipe-generator-crawler)'
+
+
+class FetchError(Exception):
+    """Raised when a URL could not be fetched within the allowed attempts."""
+
+
+def _atomic_write(path, data):
+    """Writes bytes to a file through a temporary file, so readers never see half of it."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class PageCache(object):
+    """On-disk cache of fetched pages and their validators.
+
+    Every page whose response carries an ETag or Last-Modified header is
+    stored as ``<sha256 of url>.body`` plus a ``.json`` file with the URL,
+    validators and encoding.
+
+    Args:
+        directory (str): Folder the pages are stored in.
+
+    Methods:
+        get(self, url): Returns the cached body and metadata of a URL.
+        put(self, url, response): Stores a response if it can be revalidated.
+        conditional_headers(self, url): Returns the headers that revalidate the cached copy.
+        response(self, url): Rebuilds a response from the cached copy.
+    """
+
+    def __init__(self, directory):
+        """Initializes the cache and creates its folder."""
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        """Returns the path of a URL's files, without extension."""
+        return os.path.join(self.directory, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """Returns the cached copy of a URL.
+
+        Args:
+            url (str): The page URL.
+
+        Returns:
+            tuple: (body bytes, metadata dict), or None if the URL is not cached.
+        """
+        path = self._path(url)
+        try:
+            with open(f'{path}.json') as f:
+                meta = json.load(f)
+            with open(f'{path}.body', 'rb') as f:
+                return f.read(), meta
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url, response):
+        """Stores a successful response that has an ETag or Last-Modified validator.
+
+        Args:
+            url (str): The page URL.
+            response (requests.Response): Its response.
+
+        Returns:
+            bool: Whether the response was stored.
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code != 200 or not (etag or last_modified):
+            return False
+        path = self._path(url)
+        meta = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'encoding': response.encoding,
+            'content_type': response.headers.get('Content-Type'),
+            'fetched_at': time.time(),
+        }
+        # body first, so metadata never points at a missing body
+        _atomic_write(f'{path}.body', response.content)
+        _atomic_write(f'{path}.json', json.dumps(meta).encode('utf-8'))
+        return True
+
+    def conditional_headers(self, url):
+        """Returns the headers that ask the server whether the cached copy is still current.
+
+        Args:
+            url (str): The page URL.
+
+        Returns:
+            dict: If-None-Match and/or If-Modified-Since, empty if the URL is not cached.
+        """
+        cached = self.get(url)
+        if cached is None:
+            return {}
+        meta = cached[1]
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def response(self, url):
+        """Rebuilds a 200 response from the cached copy of a URL.
+
+        Args:
+            url (str): The page URL.
+
+        Returns:
+            requests.Response: The cached page, with ``from_cache`` set to True, or None if the URL
+                is not cached (any more) or its files can't be read.
+        """
+        cached = self.get(url)
+        if cached is None:
+            return None
+        body, meta = cached
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = body
+        response.encoding = meta.get('encoding')
+        response.headers = CaseInsensitiveDict({key: value for key, value in (
+            ('ETag', meta.get('etag')),
+            ('Last-Modified', meta.get('last_modified')),
+            ('Content-Type', meta.get('content_type'))) if value})
+        response.from_cache = True
+        return response
+
+
+class JsonlSink(object):
+    """Append-only JSON Lines file that records are streamed to as they are produced.
+
+    Every record is flushed right away, so a crash loses at most the record
+    being written, and a partially written last line is ignored when reading.
+
+    Args:
+        path (str): File the records are appended to.
+
+    Methods:
+        write(self, record): Appends one record.
+        read(self): Returns every complete record in the file.
+        close(self): Closes the file.
+    """
+
+    def __init__(self, path):
+        """Opens the file for appending."""
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # end a line cut short by a crash, so the next record starts on its own line
+                    self._file.write('\n')
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, record):
+        """Appends one record.
+
+        Args:
+            record (dict): JSON-serializable record.
+        """
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def read(self):
+        """Returns every complete record in the file.
+
+        Returns:
+            list: The records, in the order they were written.
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+        records = []
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # the tail of a write interrupted by a crash
+                    continue
+        return records
+
+    def close(self):
+        """Closes the file."""
+        self._file.close()
+
+
+class VisitedCheckpoint(object):
+    """Persistent set of URLs that are done, one URL per line.
+
+    Args:
+        path (str): File the URLs are appended to.
+
+    Methods:
+        add(self, url): Marks a URL as done.
+        __contains__(self, url): Returns whether a URL is done.
+        close(self): Closes the file.
+    """
+
+    def __init__(self, path):
+        """Loads the URLs done so far and opens the file for appending."""
+        self.path = path
+        self.urls = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.urls.update(line.rstrip('\n') for line in f if line.endswith('\n'))
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, url):
+        return url in self.urls
+
+    def __len__(self):
+        return len(self.urls)
+
+    def add(self, url):
+        """Marks a URL as done.
+
+        Args:
+            url (str): The URL.
+        """
+        with self._lock:
+            if url in self.urls:
+                return
+            self.urls.add(url)
+            self._file.write(url + '\n')
+            self._file.flush()
+
+    def close(self):
+        """Closes the file."""
+        self._file.close()
+
+
+class HostLimiter(object):
+    """Caps the concurrent requests to one host and spaces them out in time.
+
+    Args:
+        max_concurrency (int): Largest number of requests in flight at once.
+        rate (float): Largest number of requests started per second, None for no limit.
+    """
+
+    def __init__(self, max_concurrency=4, rate=None):
+        """Initializes the limiter."""
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._interval = 1.0 / rate if rate else 0.0
+        self._next_start = 0.0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        """Waits for a free slot and for the next allowed start time."""
+        self._slots.acquire()
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *exc_info):
+        """Frees the slot."""
+        self._slots.release()
+
+
+class Crawler(object):
+    """Fetches URLs concurrently with per-host limits, retries and timeouts.
+
+    Args:
+        max_workers (int): Size of the thread pool, the total number of requests in flight.
+        per_host (int): Largest number of concurrent requests to one host.
+        rate (float): Largest number of requests per second to one host, None for no limit.
+        retries (int): Additional attempts after a failed request.
+        backoff (float): Seconds before the first retry, doubled on every further one.
+        timeout (tuple): (connect, read) timeouts of every request in seconds.
+        session (requests.Session, optional): Session to use, a pooled one is created if None.
+        cache (PageCache, optional): Revalidates and stores pages, unchanged pages are served from it.
+
+    Methods:
+        fetch(self, url, headers=None, stream=False): Fetches one URL on the calling thread.
+        submit(self, url, headers=None, stream=False): Fetches one URL on the pool, returns a future.
+        map(self, urls): Fetches many URLs concurrently, returns responses or errors in order.
+        close(self): Shuts the pool down and closes the session.
+    """
+
+    def __init__(self, max_workers=16, per_host=4, rate=5.0, retries=3, backoff=0.5, timeout=(5, 30), session=None,
+                 cache=None):
+        """Initializes the crawler, its pool and its session."""
+        self.cache = cache
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            # one keep-alive connection per worker, reused across requests
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = USER_AGENT
+        self.session = session
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='crawler')
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _limiter(self, url):
+        """Returns the limiter of the URL's host, creating it on first use."""
+        host = urlsplit(url).netloc
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = HostLimiter(self.per_host, self.rate)
+        return limiter
+
+    def fetch(self, url, headers=None, stream=False):
+        """Fetches one URL on the calling thread, retrying transient failures.
+
+        Args:
+            url (str): URL to GET.
+            headers (dict, optional): Extra request headers.
+            stream (bool): Return as soon as the headers arrive and leave the body to be read with
+                ``iter_content``. The caller must close the response, and it bypasses the cache.
+
+        Returns:
+            requests.Response: The response, which can still have a non-retryable error status. With a
+                cache, an unchanged page comes back as the cached 200 response with ``from_cache`` set;
+                if the cached copy is gone by the time the server answers 304, the page is fetched
+                again without validators.
+
+        Raises:
+            FetchError: If every attempt failed or returned a retryable status.
+        """
+        cache = None if stream else self.cache
+        if cache is None:
+            response = self._get(url, headers, stream)
+        else:
+            response = self._get(url, {**cache.conditional_headers(url), **(headers or {})}, stream)
+            if response.status_code == 304:
+                cached = cache.response(url)
+                if cached is not None:
+                    return cached
+                # the cached copy was evicted or can't be read since the request was made
+                logger.debug(f'{url} is not modified but no longer cached, refetching it')
+                response = self._get(url, headers, stream)
+            cache.put(url, response)
+        response.from_cache = False
+        return response
+
+    def _get(self, url, headers, stream):
+        """Sends one GET through the host's limiter, retrying transient failures.
+
+        Args:
+            url (str): URL to GET.
+            headers (dict, optional): Request headers.
+            stream (bool): Leave the body unread.
+
+        Returns:
+            requests.Response: The first response with a non-retryable status.
+
+        Raises:
+            FetchError: If every attempt failed or returned a retryable status.
+        """
+        limiter = self._limiter(url)
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                retry_after = getattr(error, 'retry_after', None)
+                time.sleep(max(delay, retry_after or 0))
+            try:
+                with limiter:
+                    response = self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                logger.debug(f'attempt {attempt + 1} of {url} failed: {e}')
+                continue
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            # hand a streamed connection back to the pool before retrying
+            response.close()
+            error = FetchError(f'{url} returned {response.status_code}')
+            # honour the server's Retry-After seconds, e.g. with 429 Too Many Requests
+            retry_after = response.headers.get('Retry-After', '')
+            error.retry_after = float(retry_after) if retry_after.isdigit() else None
+            logger.debug(f'attempt {attempt + 1} of {url} returned {response.status_code}')
+        raise FetchError(f'giving up on {url} after {self.retries + 1} attempts: {error}')
+
+    def submit(self, url, headers=None, stream=False):
+        """Fetches one URL on the pool.
+
+        Args:
+            url (str): URL to GET.
+            headers (dict, optional): Extra request headers.
+            stream (bool): Leave the body unread, see fetch.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the response, or raises FetchError.
+        """
+        return self._executor.submit(self.fetch, url, headers, stream)
+
+    def map(self, urls):
+        """Fetches many URLs concurrently.
+
+        Args:
+            urls (list): URLs to GET.
+
+        Returns:
+            list: The response, or the exception raised, of every URL in order.
+        """
+        futures = [self.submit(url) for url in urls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        """Waits for the queued requests, then shuts the pool down and closes the session."""
+        self._executor.shutdown()
+        self.session.close()
@@ -1,39 +1,363 @@
 import os
-import PIL
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import PIL.Image
 import numpy as np
 from sklearn.model_selection import train_test_split
 import torch
 from torch.utils.data import Dataset, DataLoader
 
-def load_images_and_labels(parent_folder, target_size=(150,150)):
+# per-channel values the classifier's inputs are normalized with
+NORM_MEANS = (0.38046584, 0.10854615, -0.13485776)
+NORM_STDS = (0.5249659, 0.59474176, 0.6634378)
+
+CLASS_MAPPING = {"beans" : 0, "bell_pepper" : 1, "potato" : 2, "tomato" : 3}
+
+logger = logging.getLogger(__name__)
+
+def load_images_and_labels(parent_folder, target_size=(150,150), num_workers=None, chunk_size=64, errors=None):
     """Returns image data in form of a numpy array
-    
+
+    Images are decoded and resized by a pool of worker processes writing into
+    one shared array, in sorted class folder and file name order.
+
     args: 
         parent_folder: folder containing classes of images to move through sequentially 
         target_size: size of resulting images in image array
+        num_workers: number of decoding processes, all cores if None, decodes in this process if 1
+        chunk_size: number of files handed to a worker at a time
+        errors: optional list that (path, message) of every unreadable image is appended to
+    """
+    files = list_image_files(parent_folder)
+    paths = [os.path.join(parent_folder, rel_path) for rel_path, _ in files]
+    labels = np.array([label for _, label in files], dtype=np.int64)
+    width, height = target_size
+    shape = (len(files), height, width, 3)
+
+    if len(files) == 0:
+        return np.empty(shape, dtype=np.uint8), labels
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+    try:
+        decoded, failed = decode_into([(('shm', shm.name, shape), target_size)], paths, range(len(paths)), num_workers, chunk_size)
+        shared = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        # copy out of the shared block before it is released
+        images = np.array(shared[decoded])
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+
+    for path, message in failed:
+        logger.warning(f'Error reading image {path}: {message}')
+    if errors is not None:
+        errors.extend(failed)
+    return images, labels[decoded]
+
+def _open_target(target):
+    """Opens a shared array images are decoded into.
+
+    args:
+        target: ('shm', shared memory name, shape) or ('npy', path of a .npy file)
+
+    Returns:
+        tuple: the array and the object to close once done with it (or None)
+    """
+    kind = target[0]
+    if kind == 'shm':
+        shm = shared_memory.SharedMemory(name=target[1])
+        return np.ndarray(target[2], dtype=np.uint8, buffer=shm.buf), shm
+    return np.load(target[1], mmap_mode='r+'), None
+
+def _decode_chunk(targets, paths, rows):
+    """Decodes a chunk of files into their rows of the shared arrays, runs in a worker.
+
+    Returns:
+        tuple: rows that were written, and (path, message) of files that could not be read
+    """
+    opened = [_open_target(target) for target, _ in targets]
+    sizes = [size for _, size in targets]
+    decoded = []
+    failed = []
+    try:
+        for path, row in zip(paths, rows):
+            try:
+                for (out, _), image in zip(opened, decode_variants(path, sizes)):
+                    out[row] = image
+                decoded.append(row)
+            except Exception as e:
+                failed.append((path, str(e)))
+        for out, handle in opened:
+            if handle is None:
+                out.flush()
+    finally:
+        for out, handle in opened:
+            if handle is not None:
+                del out
+                handle.close()
+        del opened
+    return decoded, failed
+
+def decode_into(targets, paths, rows, num_workers=None, chunk_size=64):
+    """Decodes image files in parallel straight into rows of shared arrays.
+
+    Every file is decoded once and resized to the size of each target.
+
+    args:
+        targets: list of (target, (width, height)) where target is ('shm', shared memory name, shape)
+            or ('npy', path of a .npy file)
+        paths: image files to decode
+        rows: row of the arrays each file is written to
+        num_workers: number of decoding processes, all cores if None, decodes in this process if 1
+        chunk_size: number of files handed to a worker at a time
+
+    Returns:
+        tuple: sorted numpy array of rows that were written, and list of (path, message) for unreadable files
     """
-    images = []
-    labels = []
-    class_mapping = {"beans" : 0, "bell_pepper" : 1, "potato" : 2, "tomato" : 3}
+    paths = list(paths)
+    rows = list(rows)
+    chunks = [(paths[i:i + chunk_size], rows[i:i + chunk_size]) for i in range(0, len(paths), chunk_size)]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(chunks))
+
+    decoded = []
+    failed = []
+    if num_workers <= 1:
+        results = [_decode_chunk(targets, chunk_paths, chunk_rows) for chunk_paths, chunk_rows in chunks]
+    else:
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(_decode_chunk, targets, chunk_paths, chunk_rows)
+                       for chunk_paths, chunk_rows in chunks]
+            results = [future.result() for future in futures]
+    for chunk_decoded, chunk_failed in results:
+        decoded.extend(chunk_decoded)
+        failed.extend(chunk_failed)
+    return np.array(sorted(decoded), dtype=np.int64), failed
+
+def list_image_files(parent_folder, class_mapping=CLASS_MAPPING):
+    """Lists the image files of every class folder in a deterministic order.
 
-    for class_folder in os.listdir(parent_folder):
+    args:
+        parent_folder: folder containing one folder of images per class
+        class_mapping: maps class folder names to labels
+
+    Returns:
+        list: (path relative to parent_folder, label) pairs sorted by class folder and file name
+    """
+    files = []
+    for class_folder in sorted(os.listdir(parent_folder)):
         class_path = os.path.join(parent_folder, class_folder)
         if os.path.isdir(class_path) and class_folder in class_mapping:
-            label = class_mapping[class_folder]
-            for image_file in os.listdir(class_path):
-                image_path = os.path.join(class_path, image_file)
-                try:
-                    image = PIL.Image.open(image_path)
-                    if image is not None:
-                        if image.mode != 'RGB':
-                            image = image.convert('RGB')
-                        image = image.resize(target_size)
-                        images.append(image)
-                        labels.append(label)
-                except Exception as e:
-                    print(f'Error reading image {image_path}: {e}')
-
-    return np.array(images), np.array(labels)
+            for image_file in sorted(os.listdir(class_path)):
+                files.append((os.path.join(class_folder, image_file), class_mapping[class_folder]))
+    return files
+
+def decode_image(image_path, target_size=(150,150)):
+    """Decodes one image into an RGB uint8 array of the target size.
+
+    args:
+        image_path: path to the image file
+        target_size: (width, height) the image is resized to
+
+    Returns:
+        numpy.ndarray: array of shape (height, width, 3)
+    """
+    return decode_variants(image_path, [target_size])[0]
+
+def decode_variants(image_path, sizes):
+    """Decodes one image once and resizes it to each of the given sizes.
+
+    JPEGs are decoded in draft mode at the smallest scale that still covers
+    the largest size, so big photos aren't fully decoded only to be shrunk.
+
+    args:
+        image_path: path to the image file
+        sizes: (width, height) of each resized copy
+
+    Returns:
+        list: arrays of shape (height, width, 3), one per size
+    """
+    image = PIL.Image.open(image_path)
+    image.draft('RGB', (max(size[0] for size in sizes), max(size[1] for size in sizes)))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return [np.asarray(image.resize(size)) for size in sizes]
+
+def select_variant(sizes, input_size):
+    """Picks the smallest stored resolution that still satisfies the model's input size.
+
+    args:
+        sizes: side lengths of the available square variants
+        input_size: side length the model takes
+
+    Returns:
+        int: the chosen side length, the largest available if none is big enough
+    """
+    large_enough = [size for size in sizes if size >= input_size]
+    return min(large_enough) if large_enough else max(sizes)
+
+def variant_file(side=None):
+    """Returns the file name of the images of one cache variant.
+
+    args:
+        side: side length of a square variant, None for the full target size
+
+    Returns:
+        str: file name inside the cache folder
+    """
+    return 'images.npy' if side is None else f'images_{side}.npy'
+
+def _file_stamp(path):
+    """Returns the size and mtime identifying the current contents of a file."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def build_image_cache(parent_folder, cache_dir, target_size=(150,150), class_mapping=CLASS_MAPPING, num_workers=None,
+                      variant_sizes=(32, 64)):
+    """Decodes a folder of class folders once into a memory-mappable image cache.
+
+    Writes to cache_dir:
+        images.npy: uint8 array of shape N x H x W x 3
+        images_<side>.npy: uint8 array of shape N x side x side x 3 for every variant size
+        labels.npy: int64 array of N labels
+        manifest.json: source path, size and mtime of every row, plus unreadable files
+
+    Every image is decoded once and resized to the target size and every
+    variant size in the same pass, so training and serving can read the
+    smallest resolution the model needs. If a manifest from an earlier build
+    with the same sizes exists, rows of unchanged files are copied from the
+    old cache and only new or modified files are decoded, in parallel by
+    num_workers processes.
+
+    args:
+        parent_folder: folder containing one folder of images per class
+        cache_dir: folder the cache is written to
+        target_size: (width, height) the images are resized to
+        class_mapping: maps class folder names to labels
+        num_workers: number of decoding processes, all cores if None
+        variant_sizes: side lengths of the additional square variants
+
+    Returns:
+        dict: the manifest of the new cache
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    labels_path = os.path.join(cache_dir, 'labels.npy')
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    variant_sizes = sorted(set(variant_sizes))
+    # (final path, temporary path, (width, height)) of every array written
+    outputs = [(os.path.join(cache_dir, variant_file()), None, tuple(target_size))]
+    outputs += [(os.path.join(cache_dir, variant_file(side)), None, (side, side)) for side in variant_sizes]
+    outputs = [(path, path + '.tmp.npy', size) for path, _, size in outputs]
+
+    # rows of the previous build that can be reused as is
+    previous = {}
+    old_arrays = []
+    if os.path.exists(manifest_path) and all(os.path.exists(path) for path, _, _ in outputs):
+        with open(manifest_path) as f:
+            old_manifest = json.load(f)
+        if (tuple(old_manifest['target_size']) == tuple(target_size)
+                and old_manifest.get('variant_sizes', []) == variant_sizes):
+            old_arrays = [np.load(path, mmap_mode='r') for path, _, _ in outputs]
+            for row, entry in enumerate(old_manifest['files']):
+                previous[entry['path']] = (entry['size'], entry['mtime_ns'], row)
+
+    files = list_image_files(parent_folder, class_mapping)
+    arrays = [np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(files), size[1], size[0], 3))
+              for _, tmp_path, size in outputs]
+    stamps = []
+    valid = np.zeros(len(files), dtype=bool)
+    to_decode = []
+    for row, (rel_path, label) in enumerate(files):
+        stamp = _file_stamp(os.path.join(parent_folder, rel_path))
+        stamps.append(stamp)
+        old = previous.get(rel_path)
+        if old is not None and old[:2] == stamp:
+            for array, old_array in zip(arrays, old_arrays):
+                array[row] = old_array[old[2]]
+            valid[row] = True
+        else:
+            to_decode.append(row)
+    reused = int(valid.sum())
+    for array in arrays:
+        array.flush()
+    del arrays, old_arrays
+
+    # workers write the new and changed images straight into the memmaps
+    decoded, failed = decode_into([(('npy', tmp_path), size) for _, tmp_path, size in outputs],
+                                  [os.path.join(parent_folder, files[row][0]) for row in to_decode],
+                                  to_decode, num_workers)
+    valid[decoded] = True
+    errors = [{'path': os.path.relpath(path, parent_folder), 'error': message} for path, message in failed]
+
+    if not valid.all():
+        # unreadable files left unused rows, copy the filled ones into right-sized files
+        for _, tmp_path, size in outputs:
+            filled = np.load(tmp_path, mmap_mode='r')
+            final_path = tmp_path + '.final.npy'
+            final = np.lib.format.open_memmap(final_path, mode='w+', dtype=np.uint8, shape=(int(valid.sum()), size[1], size[0], 3))
+            final[:] = filled[valid]
+            final.flush()
+            del final, filled
+            os.replace(final_path, tmp_path)
+
+    entries = [{'path': rel_path, 'label': label, 'size': stamp[0], 'mtime_ns': stamp[1]}
+               for (rel_path, label), stamp, ok in zip(files, stamps, valid) if ok]
+    labels = [entry['label'] for entry in entries]
+
+    manifest = {
+        'parent_folder': os.path.abspath(parent_folder),
+        'target_size': list(target_size),
+        'variant_sizes': variant_sizes,
+        'class_mapping': class_mapping,
+        'files': entries,
+        'errors': errors,
+        'reused': reused,
+    }
+    # every output is complete on disk before any of them replaces the old one
+    labels_tmp_path = labels_path + '.tmp.npy'
+    np.save(labels_tmp_path, np.array(labels, dtype=np.int64))
+    for path, tmp_path in [(labels_path, labels_tmp_path)] + [(path, tmp_path) for path, tmp_path, _ in outputs]:
+        os.replace(tmp_path, path)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+def cache_variant_sizes(cache_dir):
+    """Returns the side lengths of the square variants stored in an image cache.
+
+    args:
+        cache_dir: folder the cache was written to
+
+    Returns:
+        list: side lengths, including the full target size if it is square
+    """
+    with open(os.path.join(cache_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    sizes = list(manifest.get('variant_sizes', []))
+    width, height = manifest['target_size']
+    if width == height and width not in sizes:
+        sizes.append(width)
+    return sorted(sizes)
+
+def load_image_cache(cache_dir, side=None):
+    """Opens an image cache written by build_image_cache without reading it into memory.
+
+    args:
+        cache_dir: folder the cache was written to
+        side: side length of the variant to open, None for the full target size
+
+    Returns:
+        tuple: read-only memmap of the images and array of labels
+    """
+    if side is not None and not os.path.exists(os.path.join(cache_dir, variant_file(side))):
+        # the target size itself, stored as the main array
+        side = None
+    images = np.load(os.path.join(cache_dir, variant_file(side)), mmap_mode='r')
+    labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+    return images, labels
 
 def preprocess(images_arr):
     """Preprocess an array of images.
@@ -72,28 +396,73 @@ class Ingredients(Dataset):
         images (list): List of images.
         labels (list): List of corresponding labels.
         transform (callable, optional): Augmentation of the images.
+        to_pil (bool, optional): Whether images are converted to PIL before the transform.
 
     Attributes:
         images (list): List of images.
         labels (list): List of corresponding labels.
         transform (callable, optional): Augmentation of the images.
+        to_pil (bool): Whether images are converted to PIL before the transform.
 
     Methods:
+        from_cache(cls, cache_dir, transform=None, to_pil=True, side=None): Creates the dataset from an image cache.
         __len__(self): Returns the number of samples in the dataset.
         __getitem__(self, idx): Retrieves the item at the given index.
 
     """
-    def __init__(self, images, labels, transform=None):
+    # set when the images are memory-mapped from an image cache
+    cache_dir = None
+    cache_side = None
+
+    def __init__(self, images, labels, transform=None, to_pil=True):
         """Initializes the Ingredients dataset.
 
         Args:
             images (list): List of images.
             labels (list): List of corresponding labels.
             transform (callable, optional): Augmentation of the images.
+            to_pil (bool, optional): Whether images are converted to PIL before the transform,
+                if False the uint8 arrays are returned as is for batched augmentation.
         """
         self.images = images
         self.labels = labels
         self.transform = transform
+        self.to_pil = to_pil
+
+    @classmethod
+    def from_cache(cls, cache_dir, transform=None, to_pil=True, side=None):
+        """Creates the dataset from an image cache written by build_image_cache.
+
+        The images stay memory-mapped, so DataLoader workers share the page
+        cache instead of each receiving a pickled copy of the whole array.
+
+        Args:
+            cache_dir (str): Folder the cache was written to.
+            transform (callable, optional): Augmentation of the images.
+            to_pil (bool, optional): Whether images are converted to PIL before the transform.
+            side (int, optional): Side length of the variant to read, None for the full target size.
+
+        Returns:
+            Ingredients: Dataset reading from the cache.
+        """
+        images, labels = load_image_cache(cache_dir, side)
+        dataset = cls(images, labels, transform, to_pil)
+        dataset.cache_dir = cache_dir
+        dataset.cache_side = side
+        return dataset
+
+    def __getstate__(self):
+        """Drops memory-mapped images when pickled, they are reopened on unpickling."""
+        state = self.__dict__.copy()
+        if self.cache_dir is not None:
+            state['images'] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restores the dataset, reopening the image cache if it was dropped."""
+        self.__dict__.update(state)
+        if self.images is None:
+            self.images = load_image_cache(self.cache_dir, self.cache_side)[0]
 
     def __len__(self):
         """Returns the number of samples in the dataset.
@@ -113,7 +482,8 @@ class Ingredients(Dataset):
             tuple: A tuple containing the image and its corresponding label.
         """
         image = self.images[idx]
-        image = PIL.Image.fromarray(image)
+        if self.to_pil:
+            image = PIL.Image.fromarray(image)
         label = self.labels[idx]
         if self.transform:
             image = self.transform(image)
@@ -0,0 +1,226 @@
+"""Concurrent, deduplicating download of scraped image URLs into class folders.
+
+An ``ImageDownloader`` fetches images on a bounded thread pool through a
+``crawler.Crawler`` (one pooled keep-alive session, per-host limits, retries
+and connect/read timeouts) and streams every body to disk while hashing it,
+so an image is never held in memory as a whole or decoded and re-encoded.
+
+Files are named by the SHA-256 of their content and written to one folder per
+label, the layout ``dataset_maker.load_images_and_labels`` reads, so the same
+image found twice, or found again by a rerun, is stored once. Every download
+is appended to a JSON Lines manifest of URL, file and label; URLs whose file
+is still on disk are skipped without a request on the next run.
+
+Usage:
+    with ImageDownloader('images') as downloader:
+        summary = downloader.download_all([(url, 'tomato') for url in urls])
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import PIL.Image
+import requests
+
+from crawler import Crawler, FetchError, JsonlSink
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.jsonl'
+# unfinished downloads, not a class folder so the dataset loader never sees them
+PARTIAL_DIR = '.partial'
+EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp', 'BMP': '.bmp'}
+
+
+def image_extension(path):
+    """Checks that a file is an image PIL can read and returns its extension.
+
+    Only the header is parsed, the pixels are not decoded.
+
+    Args:
+        path (str): The file.
+
+    Returns:
+        str: Extension matching the image format, e.g. '.jpg'.
+
+    Raises:
+        ValueError: If the file is not a readable image.
+    """
+    try:
+        with PIL.Image.open(path) as image:
+            image_format = image.format
+            image.verify()
+    except (OSError, SyntaxError, ValueError) as e:
+        raise ValueError(f'not an image: {e}') from e
+    return EXTENSIONS.get(image_format, '.' + image_format.lower())
+
+
+class ImageDownloader(object):
+    """Downloads images into one folder per label, deduplicated by content.
+
+    Args:
+        root (str): Folder the class folders and the manifest are written to.
+        crawler (crawler.Crawler, optional): Fetches the images, one with max_workers workers is created if None.
+        max_workers (int): Number of downloads in flight at once.
+        max_bytes (int): Largest image accepted, bigger downloads are abandoned.
+        chunk_size (int): Bytes read from the network and written to disk at a time.
+        manifest_path (str, optional): JSON Lines manifest, root/manifest.jsonl if None.
+
+    Methods:
+        download(self, url, label): Downloads one image on the calling thread.
+        submit(self, url, label): Downloads one image on the pool, returns a future.
+        download_all(self, items): Downloads many images concurrently and summarizes the outcome.
+        close(self): Waits for the queued downloads and releases the pool, session and manifest.
+    """
+
+    def __init__(self, root, crawler=None, max_workers=16, max_bytes=20 * 2 ** 20, chunk_size=64 * 1024,
+                 manifest_path=None):
+        """Creates the folders, loads the manifest of earlier runs and starts the pool."""
+        self.root = root
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._partial_dir = os.path.join(root, PARTIAL_DIR)
+        os.makedirs(self._partial_dir, exist_ok=True)
+        self._owns_crawler = crawler is None
+        self.crawler = crawler if crawler is not None else Crawler(max_workers=max_workers)
+        self.manifest = JsonlSink(manifest_path or os.path.join(root, MANIFEST_NAME))
+        # latest record of every URL downloaded so far, in this run or an earlier one
+        self.records = {record['url']: record for record in self.manifest.read()}
+        # files written in this run, so two workers with the same image write it once
+        self._written = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='image-downloader')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def download(self, url, label):
+        """Downloads one image on the calling thread.
+
+        Args:
+            url (str): URL of the image.
+            label (str): Class of the image, the name of the folder it is written to.
+
+        Returns:
+            dict: Manifest record with 'url', 'file' (relative to root), 'label', 'sha256', 'bytes' and
+                'status', which is 'downloaded', 'duplicate' (the content is already on disk) or
+                'skipped' (the URL was downloaded by an earlier run).
+
+        Raises:
+            FetchError: If the URL could not be fetched or is not an acceptable image.
+        """
+        record = self.records.get(url)
+        if record is not None and record['label'] == label and os.path.exists(os.path.join(self.root, record['file'])):
+            return {**record, 'status': 'skipped'}
+
+        response = self.crawler.fetch(url, stream=True)
+        try:
+            if response.status_code != 200:
+                raise FetchError(f'{url} returned {response.status_code}')
+            content_type = response.headers.get('Content-Type', '')
+            if content_type and not content_type.startswith('image/'):
+                raise FetchError(f'{url} is {content_type}, not an image')
+            if int(response.headers.get('Content-Length') or 0) > self.max_bytes:
+                raise FetchError(f'{url} is larger than {self.max_bytes} bytes')
+            tmp_path, digest, size = self._stream_to_file(url, response)
+        finally:
+            response.close()
+
+        try:
+            extension = image_extension(tmp_path)
+        except ValueError as e:
+            os.remove(tmp_path)
+            raise FetchError(f'{url}: {e}') from e
+        file = os.path.join(label, digest[:32] + extension)
+        path = os.path.join(self.root, file)
+        with self._lock:
+            duplicate = file in self._written or os.path.exists(path)
+            self._written.add(file)
+        if duplicate:
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+
+        record = {'url': url, 'file': file, 'label': label, 'sha256': digest, 'bytes': size}
+        self.manifest.write(record)
+        self.records[url] = record
+        return {**record, 'status': 'duplicate' if duplicate else 'downloaded'}
+
+    def _stream_to_file(self, url, response):
+        """Writes a response body to a temporary file chunk by chunk, hashing it on the way.
+
+        Args:
+            url (str): URL of the response, for error messages.
+            response (requests.Response): Streamed response, its body not read yet.
+
+        Returns:
+            tuple: (temporary path, hex SHA-256 of the body, size in bytes).
+
+        Raises:
+            FetchError: If the connection fails mid-body or the body exceeds max_bytes.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._partial_dir)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise FetchError(f'{url} is larger than {self.max_bytes} bytes')
+                    digest.update(chunk)
+                    f.write(chunk)
+        except requests.RequestException as e:
+            os.remove(tmp_path)
+            raise FetchError(f'{url} failed mid-download: {e}') from e
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest(), size
+
+    def submit(self, url, label):
+        """Downloads one image on the pool.
+
+        Args:
+            url (str): URL of the image.
+            label (str): Class of the image.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the record returned by download, or raises FetchError.
+        """
+        return self._executor.submit(self.download, url, label)
+
+    def download_all(self, items):
+        """Downloads many images concurrently, logging the ones that fail.
+
+        Args:
+            items (iterable): (url, label) pairs. Can be a generator, every download starts as soon
+                as its pair is produced.
+
+        Returns:
+            dict: Number of images 'downloaded', 'duplicate', 'skipped' and 'failed'.
+        """
+        futures = {self.submit(url, label): url for url, label in items}
+        summary = {'downloaded': 0, 'duplicate': 0, 'skipped': 0, 'failed': 0}
+        for future in as_completed(futures):
+            try:
+                summary[future.result()['status']] += 1
+            except FetchError as e:
+                summary['failed'] += 1
+                logger.warning(f'Skipping image {futures[future]}: {e}')
+        return summary
+
+    def close(self):
+        """Waits for the queued downloads, then releases the pool, the crawler if it was created here, and the manifest."""
+        self._executor.shutdown()
+        if self._owns_crawler:
+            self.crawler.close()
+        self.manifest.close()
@@ -1,10 +1,8 @@
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-import requests
-import io
 import os
-from PIL import Image
 import time
+from image_downloader import ImageDownloader
 
 '''
 This py file is used to scrape images of keywords from google images using selenium and BeautifulSoup
@@ -43,21 +41,28 @@ def main():
     if not os.path.exists(file_name):
         os.mkdir(file_name)
 
-    # Loop through each key word and download the desired number of images
-    count = 0
-    for i in data_list:
-        search_url = Google_Image + 'q=' + i #'q=' because its a query
-        print(search_url)
-        urls = scrape_images(search_url, wd, 1, num_images)
-        print(f"Found {len(urls)} images")
+    # file_name is the ingredient's class folder, the downloader writes it as one label under its parent
+    # folder, next to the other classes, and keeps its manifest there
+    root = os.path.dirname(os.path.abspath(file_name))
+    label = os.path.basename(os.path.abspath(file_name))
+
+    # Loop through each key word and yield the urls of its images, labelled with the class folder name
+    def scraped_urls():
+        for i in data_list:
+            search_url = Google_Image + 'q=' + i #'q=' because its a query
+            print(search_url)
+            urls = scrape_images(search_url, wd, 1, num_images)
+            print(f"Found {len(urls)} images")
+            for url in urls:
+                yield url, label
+
+    # Images download concurrently while the next key word is scraped. Files are named by their
+    # content, so reruns skip what is already downloaded instead of writing duplicates.
+    with ImageDownloader(root) as downloader:
+        summary = downloader.download_all(scraped_urls())
+    print(f"Downloaded {summary['downloaded']}, duplicates {summary['duplicate']}, "
+          f"already present {summary['skipped']}, failed {summary['failed']}")
 
-        # loop through the list of image urls and download them
-        for j, url in enumerate(urls):
-            download_image(file_name + "/", url, str(count) + ".jpg")
-            count += 1
-        
-        print("Success!")
-            
     print("Complete!")
     wd.quit()
 
@@ -126,50 +131,6 @@ def scrape_images(initial_url, wd, delay, max_images):
     # Returns all of the usable image URLs.
     return image_urls 
                     
-def download_image(download_path, url, file_name):
-    """
-    Downloads an image from a given URL and saves it to a specified file path.
-    This function attempts to download an image from the provided URL and save it to the specified file path. 
-    It handles potential errors that may occur during the download and save process, such as failed requests, 
-    invalid image formats, and file writing errors.
-    
-    This function requires the `requests`, `io`, and `PIL` (Python Imaging Library) modules to be imported.
-    Parameters:
-        download_path (str): The directory path where the image will be saved.
-        url (str): The URL of the image to download.
-        file_name (str): The name of the file to save the image as.
-    Returns: None
-    """
-    try:
-        image_content = requests.get(url).content
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to download image from {url} - {e}")
-        return  # Return without attempting to process the image further
-
-    try:
-        image_file = io.BytesIO(image_content)
-        image = Image.open(image_file)
-    except (IOError, OSError) as e:
-        print(f"Failed to open image file - {e}")
-        return  # Return without attempting to process the image further
-    
-    try:
-        # Convert image to RGB mode
-        image = image.convert('RGB')
-    
-        file_path = os.path.join(download_path, file_name)
-        try:
-            with open(file_path, "wb") as f:
-                image.save(f, "JPEG")
-            print(f"Downloaded: {file_name}")
-        except Exception as e:
-            print(f"Failed to save image - {e}")
-            return
-    except Exception as e:
-        print("Failed -", e)
-        return
-        
-
 if __name__ == '__main__':
     '''
     - calls main when the file is called in the terminal
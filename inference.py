@@ -0,0 +1,194 @@
+"""Helpers for classifying uploaded ingredient images with a trained model.
+
+Serving uses its own deterministic preprocessing rather than the training
+augmentation: images are decoded once (JPEGs at a reduced scale when the
+target is small), resized on the shorter side, center cropped and normalized
+straight into a preallocated batch tensor. The same steps are available as a
+torchvision transform for datasets through ``eval_transform``.
+"""
+
+import contextlib
+import io
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from dataset_maker import NORM_MEANS, NORM_STDS
+from prediction_cache import content_key
+
+# side length of the square images the classifier takes
+INPUT_SIZE = 32
+# largest number of images sent through the model in one forward pass
+MAX_BATCH_SIZE = 32
+
+_MEANS = torch.tensor(NORM_MEANS).view(1, 3, 1, 1)
+_STDS = torch.tensor(NORM_STDS).view(1, 3, 1, 1)
+
+
+def _untimed(name):
+    """Stage context used when classify_uploads is not given a timer."""
+    return contextlib.nullcontext()
+
+
+def eval_transform(size=INPUT_SIZE):
+    """Returns the deterministic preprocessing as a transform for PIL images.
+
+    Args:
+        size (int): Side length of the resulting images.
+
+    Returns:
+        torchvision.transforms.Compose: Resize, center crop, to tensor and normalize.
+    """
+    return transforms.Compose([
+        transforms.Resize(size),
+        transforms.CenterCrop(size),
+        transforms.ToTensor(),
+        transforms.Normalize(NORM_MEANS, NORM_STDS)
+    ])
+
+
+def load_image(fp, size=INPUT_SIZE):
+    """Decodes an image and resizes and center crops it to size x size.
+
+    JPEGs are decoded in draft mode at the smallest scale that still covers
+    the target, which skips most of the decoding work for large photos.
+
+    Args:
+        fp: Filename or file object of the image.
+        size (int): Side length of the resulting image.
+
+    Returns:
+        PIL.Image.Image: RGB image of shape size x size.
+    """
+    image = Image.open(fp)
+    image.draft('RGB', (size, size))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # same geometry as transforms.Resize(size) followed by transforms.CenterCrop(size)
+    width, height = image.size
+    if width <= height:
+        resized = (size, int(size * height / width))
+    else:
+        resized = (int(size * width / height), size)
+    image = image.resize(resized, Image.BILINEAR)
+    left = int(round((resized[0] - size) / 2.0))
+    top = int(round((resized[1] - size) / 2.0))
+    return image.crop((left, top, left + size, top + size))
+
+
+def to_batch(images, size=INPUT_SIZE, out=None):
+    """Normalizes loaded images into a single batch tensor.
+
+    Args:
+        images (list): RGB PIL images of shape size x size, as returned by ``load_image``.
+        size (int): Side length of the images.
+        out (torch.Tensor, optional): Preallocated float tensor with room for at least
+            len(images) images, the batch is written into its leading rows.
+
+    Returns:
+        torch.Tensor: Normalized batch of shape (N, 3, size, size).
+    """
+    if out is None:
+        out = torch.empty((len(images), 3, size, size))
+    batch = out[:len(images)]
+    pixels = np.empty((len(images), size, size, 3), dtype=np.uint8)
+    for i, image in enumerate(images):
+        pixels[i] = np.asarray(image)
+    batch.copy_(torch.from_numpy(pixels).permute(0, 3, 1, 2))
+    return batch.div_(255.0).sub_(_MEANS).div_(_STDS)
+
+
+def load_batch(files, size=INPUT_SIZE, out=None):
+    """Decodes and preprocesses uploaded images into one batch.
+
+    Args:
+        files (list): Filenames or file objects of the images.
+        size (int): Side length the images are resized to.
+        out (torch.Tensor, optional): Preallocated float tensor to write the batch into.
+
+    Returns:
+        tuple: The normalized batch and a list of (file, error) for files that could not be read.
+    """
+    images = []
+    errors = []
+    for fp in files:
+        try:
+            images.append(load_image(fp, size))
+        except Exception as e:
+            errors.append((fp, e))
+    return to_batch(images, size, out), errors
+
+
+def predict(model, images, max_batch_size=MAX_BATCH_SIZE):
+    """Classifies a batch of images with as few forward passes as possible.
+
+    Args:
+        model (torch.nn.Module): Model in eval mode.
+        images (torch.Tensor): Batch of preprocessed images, shape (N, C, H, W).
+        max_batch_size (int): Largest chunk sent through the model at once.
+
+    Returns:
+        torch.Tensor: Predicted class index of each image, shape (N,).
+    """
+    predictions = []
+    with torch.inference_mode():
+        for chunk in torch.split(images, max_batch_size):
+            outputs = model(chunk)
+            predictions.append(torch.argmax(outputs, dim=1))
+    if not predictions:
+        return torch.empty(0, dtype=torch.long)
+    return torch.cat(predictions)
+
+
+def classify_uploads(model, uploads, version=None, cache=None, max_batch_size=MAX_BATCH_SIZE, timer=None):
+    """Classifies raw uploaded files, answering repeated images from the cache.
+
+    Cached images are neither decoded nor sent through the model, the rest are
+    classified together as one batch.
+
+    Args:
+        model (torch.nn.Module): Model in eval mode.
+        uploads (list): Raw bytes of each uploaded file.
+        version (str, optional): Identity of the checkpoint the model was loaded from.
+        cache (PredictionCache, optional): Cache of earlier predictions.
+        max_batch_size (int): Largest chunk sent through the model at once.
+        timer (StageTimer, optional): Times the decode, preprocess and forward stages.
+
+    Returns:
+        tuple: Predicted class index of each readable upload in upload order,
+        and a list of (upload index, error) for the uploads that could not be read.
+    """
+    stage = timer.stage if timer is not None else _untimed
+    predictions = [None] * len(uploads)
+    keys = [None] * len(uploads)
+    images = []
+    decoded = []
+    errors = []
+    with stage('decode'):
+        for i, data in enumerate(uploads):
+            if cache is not None:
+                keys[i] = content_key(data)
+                predictions[i] = cache.get(keys[i], version)
+                if predictions[i] is not None:
+                    continue
+            try:
+                images.append(load_image(io.BytesIO(data)))
+                decoded.append(i)
+            except Exception as e:
+                errors.append((i, e))
+
+    if images:
+        with stage('preprocess'):
+            batch = to_batch(images)
+        # includes the wait for a shared forward pass when the model is an InferenceScheduler
+        with stage('forward'):
+            pred_classes = predict(model, batch, max_batch_size).tolist()
+        for i, pred_class in zip(decoded, pred_classes):
+            predictions[i] = pred_class
+            if cache is not None:
+                cache.put(keys[i], version, pred_class)
+
+    return [pred_class for pred_class in predictions if pred_class is not None], errors
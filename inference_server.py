@@ -0,0 +1,208 @@
+"""Dynamic micro-batching of forward passes across request threads.
+
+Request threads hand their preprocessed images to an ``InferenceScheduler``
+instead of calling the model themselves. A single background worker owns the
+forward pass: it waits up to ``max_wait_ms`` for other requests to arrive,
+runs everything it collected (at most ``max_batch_size`` images) as one batch
+and resolves each request's future with its slice of the outputs. Requests
+are rejected with ``QueueFullError`` once ``max_queue`` are already waiting,
+so an overloaded worker sheds load instead of queueing without bound.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from inference import MAX_BATCH_SIZE
+
+# tells the worker thread to exit
+_STOP = object()
+
+
+class QueueFullError(Exception):
+    """Raised when too many requests are already waiting for the model."""
+
+
+class InferenceScheduler(object):
+    """Collects images from concurrent requests into shared forward passes.
+
+    Calling the scheduler on a batch behaves like calling the model, so it can
+    be passed anywhere a model is expected, e.g. ``inference.predict``. A
+    request can name the model it must run on (see ``bind``), so a caller that
+    keys results by checkpoint version gets outputs of that very checkpoint
+    even if it is hot-reloaded while the request waits.
+
+    Args:
+        get_model (callable): Returns the model in eval mode, called once per batch
+            for requests that don't name one, so a hot-reloaded checkpoint is picked up.
+        max_wait_ms (float): Longest time the first request of a batch waits for others.
+        max_batch_size (int): Largest number of images in one forward pass.
+        max_queue (int): Largest number of requests waiting for the model.
+
+    Methods:
+        submit(self, images, model=None): Queues a batch of images, returns a future of the outputs.
+        __call__(self, images, timeout=None, model=None): Queues a batch of images and waits for the outputs.
+        bind(self, model): Returns a callable that runs images on the given model through the scheduler.
+        close(self): Stops the worker once the queued requests are done.
+    """
+
+    def __init__(self, get_model, max_wait_ms=5, max_batch_size=MAX_BATCH_SIZE, max_queue=64):
+        """Initializes the scheduler, the worker thread starts on the first request.
+
+        Args:
+            get_model (callable): Returns the model in eval mode.
+            max_wait_ms (float): Longest time the first request of a batch waits for others.
+            max_batch_size (int): Largest number of images in one forward pass.
+            max_queue (int): Largest number of requests waiting for the model.
+        """
+        self.get_model = get_model
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue(max_queue)
+        self._carry = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, images, model=None):
+        """Queues a batch of images for the next forward pass.
+
+        Args:
+            images (torch.Tensor): Preprocessed images, shape (N, C, H, W).
+            model (torch.nn.Module, optional): Model to run them on, the one get_model returns at batch time if None.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the model outputs for these images.
+
+        Raises:
+            QueueFullError: If max_queue requests are already waiting.
+        """
+        self._start()
+        future = Future()
+        try:
+            self._queue.put_nowait((images, future, model))
+        except queue.Full:
+            raise QueueFullError(f'{self._queue.maxsize} requests already waiting for the model')
+        return future
+
+    def __call__(self, images, timeout=None, model=None):
+        """Queues a batch of images and waits for the outputs.
+
+        Args:
+            images (torch.Tensor): Preprocessed images, shape (N, C, H, W).
+            timeout (float, optional): Seconds to wait for the outputs.
+            model (torch.nn.Module, optional): Model to run them on, the one get_model returns at batch time if None.
+
+        Returns:
+            torch.Tensor: Model outputs for these images.
+        """
+        return self.submit(images, model).result(timeout)
+
+    def bind(self, model):
+        """Returns a callable that runs images on the given model through the scheduler.
+
+        Args:
+            model (torch.nn.Module): Model in eval mode, e.g. the one whose version results are cached under.
+
+        Returns:
+            callable: Takes a batch of images and returns the model outputs, usable as a model.
+        """
+        return lambda images: self(images, model=model)
+
+    def close(self):
+        """Stops the worker once the requests queued so far are done."""
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(_STOP)
+                self._thread.join()
+                self._thread = None
+
+    def _start(self):
+        """Starts the worker thread if it is not running yet."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """Worker loop, runs one collected batch at a time until stopped."""
+        while True:
+            pending = self._collect()
+            if pending is None:
+                return
+            self._run_batch(pending)
+
+    def _collect(self):
+        """Waits for requests and gathers them into the next batch.
+
+        Returns:
+            list: (images, future, model) tuples to run together, None once the scheduler is closed.
+        """
+        first = self._carry if self._carry is not None else self._queue.get()
+        self._carry = None
+        if first is _STOP:
+            return None
+
+        pending = [first]
+        count = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            # anything that doesn't fit starts the next batch
+            if item is _STOP or count + len(item[0]) > self.max_batch_size:
+                self._carry = item
+                break
+            pending.append(item)
+            count += len(item[0])
+        return pending
+
+    def _run_batch(self, pending):
+        """Runs the collected requests through the model and resolves their futures.
+
+        Requests that named different models (around a hot reload) are run as
+        one forward pass per model.
+
+        Args:
+            pending (list): (images, future, model) tuples to run together.
+        """
+        pending = [item for item in pending if item[1].set_running_or_notify_cancel()]
+        if not pending:
+            return
+        groups = {}
+        try:
+            current = None
+            for images, future, model in pending:
+                if model is None:
+                    current = current if current is not None else self.get_model()
+                    model = current
+                groups.setdefault(id(model), (model, []))[1].append((images, future))
+        except Exception as e:
+            for _, future, _ in pending:
+                future.set_exception(e)
+            return
+
+        for model, requests in groups.values():
+            try:
+                batch = torch.cat([images for images, _ in requests])
+                with torch.inference_mode():
+                    # a single request can still be larger than max_batch_size
+                    outputs = torch.cat([model(chunk) for chunk in torch.split(batch, self.max_batch_size)])
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for images, future in requests:
+                future.set_result(outputs[start:start + len(images)])
+                start += len(images)
@@ -0,0 +1,398 @@
+"""Hot-path instrumentation of the web app.
+
+- ``MetricsRegistry`` keeps counters and histograms in memory and renders them
+  in the Prometheus text exposition format for a ``/metrics`` route.
+- ``StageTimer`` times the stages of one request (upload read, decode,
+  preprocess, forward, recipe lookup, template render) into a histogram and
+  keeps them for the request's log line.
+- ``SamplingProfiler`` samples the stack of one thread at a fixed interval and
+  writes collapsed stacks that flame graph tools read, so a single slow
+  request can be profiled in production without tracing every call.
+- ``StructuredFormatter`` writes log records as ``key=value`` lines.
+"""
+
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Counts, defaultdict
+
+# seconds, from a millisecond cache hit up to a slow multi-image upload
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labelnames, values, extra=()):
+    """Formats label names and values as a Prometheus label set.
+
+    Args:
+        labelnames (tuple): Names of the labels.
+        values (tuple): Their values, in the same order.
+        extra (tuple): Additional (name, value) pairs, e.g. the ``le`` of a bucket.
+
+    Returns:
+        str: ``{name="value",...}``, or an empty string without labels.
+    """
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    """Formats a sample value the way Prometheus expects, including infinity."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """Monotonically increasing count, optionally split by labels.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text.
+        labelnames (tuple): Names of the labels every increment is given.
+
+    Methods:
+        inc(self, amount=1, **labels): Adds amount to the count of the given labels.
+        render(self): Returns the metric in the text exposition format.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        """Initializes an empty counter."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Adds amount to the count of the given labels.
+
+        Args:
+            amount (float): Non-negative increment.
+            **labels: Value of every label name.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        """Returns the metric in the text exposition format.
+
+        Returns:
+            list: Lines of the metric.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets, optionally split by labels.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text.
+        labelnames (tuple): Names of the labels every observation is given.
+        buckets (tuple): Upper bounds of the buckets, in increasing order.
+
+    Methods:
+        observe(self, value, **labels): Records one value.
+        time(self, **labels): Context manager observing the seconds its block takes.
+        render(self): Returns the metric in the text exposition format.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Initializes an empty histogram."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # per label set: [count per bucket (not cumulative), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Records one value.
+
+        Args:
+            value (float): The observation, e.g. a duration in seconds.
+            **labels: Value of every label name.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the seconds the block takes.
+
+        Args:
+            **labels: Value of every label name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        """Returns the metric in the text exposition format.
+
+        Returns:
+            list: Lines of the metric.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class MetricsRegistry(object):
+    """Named collection of metrics rendered together.
+
+    Methods:
+        counter(self, name, documentation, labelnames=()): Creates and registers a counter.
+        histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS): Creates and registers a histogram.
+        render(self): Returns every metric in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        """Initializes an empty registry."""
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        """Adds a metric, refusing duplicate names."""
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """Creates and registers a counter.
+
+        Returns:
+            Counter: The new counter.
+        """
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Creates and registers a histogram.
+
+        Returns:
+            Histogram: The new histogram.
+        """
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The exposition, ending with a newline.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return ''.join(line + '\n' for metric in metrics for line in metric.render())
+
+
+class StageTimer(object):
+    """Times the stages of one request.
+
+    Every stage is observed in a histogram labelled with the stage name and
+    also kept, summed per stage, for the request's log line.
+
+    Args:
+        histogram (Histogram, optional): Histogram with a 'stage' label to observe the durations in.
+
+    Methods:
+        stage(self, name): Context manager timing one stage.
+        durations_ms(self): Returns the time spent in every stage so far.
+    """
+
+    def __init__(self, histogram=None):
+        """Initializes the timer with no stages recorded."""
+        self.histogram = histogram
+        self.durations = defaultdict(float)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the block as the given stage.
+
+        Args:
+            name (str): Name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        """Records a duration measured elsewhere.
+
+        Args:
+            name (str): Name of the stage.
+            seconds (float): Time spent in it.
+        """
+        self.durations[name] += seconds
+        if self.histogram is not None:
+            self.histogram.observe(seconds, stage=name)
+
+    def durations_ms(self):
+        """Returns the time spent in every stage so far.
+
+        Returns:
+            dict: Milliseconds by stage name, rounded to microseconds.
+        """
+        return {name: round(seconds * 1000.0, 3) for name, seconds in self.durations.items()}
+
+
+class SamplingProfiler(object):
+    """Samples the stack of one thread at a fixed interval.
+
+    A background thread reads the target thread's current frame every
+    interval seconds, so the profiled code runs at full speed apart from the
+    sampling itself. The result is written as collapsed stacks
+    (``outer;inner;leaf count`` per line) that flamegraph.pl and speedscope read.
+
+    Args:
+        thread_id (int, optional): ``threading.get_ident()`` of the thread to sample, the calling thread if None.
+        interval (float): Seconds between samples.
+
+    Methods:
+        start(self): Starts sampling.
+        stop(self): Stops sampling and returns the number of samples taken.
+        collapsed(self): Returns the samples as collapsed stack lines.
+        write(self, path): Writes the collapsed stacks to a file.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        """Initializes the profiler, nothing is sampled until start is called."""
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.samples = _Counts()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts sampling in a background thread."""
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling.
+
+        Returns:
+            int: Number of samples taken.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        return sum(self.samples.values())
+
+    def collapsed(self):
+        """Returns the samples as collapsed stack lines, most frequent first.
+
+        Returns:
+            list: ``frame;frame;frame count`` strings.
+        """
+        return [f'{stack} {count}' for stack, count in self.samples.most_common()]
+
+    def write(self, path):
+        """Writes the collapsed stacks to a file.
+
+        Args:
+            path (str): Destination file.
+        """
+        with open(path, 'w') as f:
+            f.writelines(line + '\n' for line in self.collapsed())
+
+    def _run(self):
+        """Sampling loop, runs until stop is called."""
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats log records as ``key=value`` pairs.
+
+    The message becomes the ``event`` field and any fields passed as
+    ``extra={'fields': {...}}`` are appended, so every line can be parsed
+    without regular expressions.
+    """
+
+    def format(self, record):
+        """Formats one record.
+
+        Args:
+            record (logging.LogRecord): The record.
+
+        Returns:
+            str: The formatted line.
+        """
+        fields = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        fields.update(getattr(record, 'fields', {}))
+        line = ' '.join(f'{key}={self._quote(value)}' for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+    @staticmethod
+    def _quote(value):
+        """Quotes a value if it contains spaces, quotes or equals signs."""
+        text = str(value)
+        if not text or any(c in text for c in ' "=\n'):
+            return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        return text
+
+
+def configure_logging(level='INFO'):
+    """Sends log records of the app's loggers to stderr as structured lines.
+
+    Args:
+        level (str): Lowest level that is logged, e.g. 'DEBUG' or 'WARNING'.
+    """
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not any(isinstance(handler.formatter, StructuredFormatter) for handler in root.handlers):
+        handler = logging.StreamHandler()
+        handler.setFormatter(StructuredFormatter())
+        root.addHandler(handler)
@@ -0,0 +1,131 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from dataset_maker import NORM_MEANS, NORM_STDS
+
+
+class BatchAugment(object):
+    """Collate function that augments whole batches of uint8 images as tensors.
+
+    Replaces the per-sample RandomHorizontalFlip, RandomResizedCrop, ToTensor and
+    Normalize transforms: the samples of a batch are stacked once, every image is
+    flipped and crop-resized by a single batched ``grid_sample`` call, and the small
+    result is normalized with one fused multiply-subtract. Without training it
+    resizes and center crops instead, matching the deterministic evaluation transform.
+    Unlike the PIL resize, the random crops are sampled bilinearly without antialiasing.
+
+    Args:
+        size (int): Side length of the output images.
+        train (bool): Whether to apply the random augmentation.
+        scale (tuple): Range of the crop area as a fraction of the image area.
+        ratio (tuple): Range of the crop aspect ratio.
+        flip_p (float): Probability of flipping an image horizontally.
+        mean (tuple): Per-channel means to normalize with.
+        std (tuple): Per-channel standard deviations to normalize with.
+
+    Methods:
+        __call__(self, samples): Collates (image, label) samples into an augmented batch.
+        augment(self, images): Augments a stacked uint8 batch.
+    """
+
+    def __init__(self, size=32, train=True, scale=(0.08, 1.0), ratio=(3 / 4, 4 / 3), flip_p=0.5,
+                 mean=NORM_MEANS, std=NORM_STDS):
+        """Initializes the augmentation.
+
+        Args:
+            size (int): Side length of the output images.
+            train (bool): Whether to apply the random augmentation.
+            scale (tuple): Range of the crop area as a fraction of the image area.
+            ratio (tuple): Range of the crop aspect ratio.
+            flip_p (float): Probability of flipping an image horizontally.
+            mean (tuple): Per-channel means to normalize with.
+            std (tuple): Per-channel standard deviations to normalize with.
+        """
+        self.size = size
+        self.train = train
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.flip_p = flip_p
+        std = torch.tensor(std).view(1, 3, 1, 1)
+        # (x / 255 - mean) / std folded into one multiply and one subtract
+        self.mul = 1.0 / (255.0 * std)
+        self.sub = torch.tensor(mean).view(1, 3, 1, 1) / std
+
+    def __call__(self, samples):
+        """Collates (image, label) samples into an augmented batch.
+
+        Args:
+            samples (list): (uint8 array of shape H x W x 3, label) pairs.
+
+        Returns:
+            tuple: Float batch of shape (N, 3, size, size) and tensor of labels.
+        """
+        images = torch.from_numpy(np.stack([image for image, _ in samples]))
+        labels = torch.as_tensor(np.array([label for _, label in samples]))
+        return self.augment(images), labels
+
+    def augment(self, images):
+        """Augments a stacked uint8 batch.
+
+        Args:
+            images (torch.Tensor): uint8 batch of shape (N, H, W, 3).
+
+        Returns:
+            torch.Tensor: Normalized float batch of shape (N, 3, size, size).
+        """
+        images = images.permute(0, 3, 1, 2).contiguous().float()
+        if not self.train:
+            return self._normalize(self._resize_center_crop(images))
+
+        n, _, height, width = images.shape
+        # crop size as a fraction of the image side, like RandomResizedCrop
+        area = torch.empty(n).uniform_(*self.scale)
+        aspect = torch.exp(torch.empty(n).uniform_(*self.log_ratio))
+        crop_w = torch.sqrt(area * aspect * height / width).clamp_(max=1.0)
+        crop_h = torch.sqrt(area / aspect * width / height).clamp_(max=1.0)
+        # crop centers in grid_sample's [-1, 1] coordinates, kept inside the image
+        center_x = (torch.rand(n) * 2 - 1) * (1 - crop_w)
+        center_y = (torch.rand(n) * 2 - 1) * (1 - crop_h)
+        flip = torch.where(torch.rand(n) < self.flip_p, -1.0, 1.0)
+
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = crop_w * flip
+        theta[:, 0, 2] = center_x
+        theta[:, 1, 1] = crop_h
+        theta[:, 1, 2] = center_y
+        grid = F.affine_grid(theta, (n, 3, self.size, self.size), align_corners=False)
+        # crops stay inside the image, so normalizing after sampling gives the same result on far fewer pixels
+        return self._normalize(F.grid_sample(images, grid, mode='bilinear', align_corners=False))
+
+    def _normalize(self, images):
+        """Scales pixel values to [0, 1] and normalizes them in place.
+
+        Args:
+            images (torch.Tensor): Float batch of shape (N, 3, H, W) with values in [0, 255].
+
+        Returns:
+            torch.Tensor: The normalized batch.
+        """
+        return images.mul_(self.mul).sub_(self.sub)
+
+    def _resize_center_crop(self, images):
+        """Resizes the shorter side to size and center crops, without randomness.
+
+        Args:
+            images (torch.Tensor): Float batch of shape (N, 3, H, W).
+
+        Returns:
+            torch.Tensor: Batch of shape (N, 3, size, size).
+        """
+        height, width = images.shape[2:]
+        if width <= height:
+            resized = (int(self.size * height / width), self.size)
+        else:
+            resized = (self.size, int(self.size * width / height))
+        images = F.interpolate(images, size=resized, mode='bilinear', align_corners=False, antialias=True)
+        top = int(round((resized[0] - self.size) / 2.0))
+        left = int(round((resized[1] - self.size) / 2.0))
+        return images[:, :, top:top + self.size, left:left + self.size].contiguous()
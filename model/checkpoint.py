@@ -0,0 +1,230 @@
+import os
+import glob
+import random
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def _to_cpu(state):
+    """Returns a copy of a (nested) state dict with every tensor cloned to the CPU.
+
+    Args:
+        state: State dict, list, tuple or value to copy.
+
+    Returns:
+        The copy, independent of further training steps.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: _to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
+
+
+def rng_state():
+    """Returns the state of every random number generator training draws from.
+
+    Returns:
+        dict: Python, numpy, torch and (if available) CUDA generator states.
+    """
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores the generator states returned by rng_state.
+
+    Args:
+        state (dict): States to restore.
+    """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    """Saves an object with torch.save so the file at path is never left half written.
+
+    Args:
+        obj: Object to save.
+        path (str): Destination file.
+    """
+    tmp_path = f'{path}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager(object):
+    """Writes resumable training checkpoints in the background.
+
+    Every checkpoint holds the model, optimizer and scheduler state, the random
+    number generator states and the epoch, so a run can continue exactly where
+    it stopped. The states are copied to the CPU on the training thread and
+    serialized by a background thread, files are written to a temporary name
+    and renamed into place, and only the last keep_last epoch checkpoints are
+    kept next to ``best.pt``.
+
+    Args:
+        directory (str): Folder the checkpoints are written to.
+        keep_last (int): Number of most recent epoch checkpoints to keep.
+        weights_path (str, optional): Path the bare model state dict of the best
+            checkpoint is also written to, for ``run_test`` and the web app.
+
+    Methods:
+        save(self, epoch, model, optimizer, scheduler, best=False, **extra): Queues a checkpoint of the training state.
+        checkpoints(self): Lists the epoch checkpoints on disk, oldest first.
+        latest(self): Returns the path of the most recent checkpoint.
+        resume(self, model, optimizer, scheduler, path=None, map_location='cpu'): Restores a checkpoint.
+        wait(self): Blocks until the queued checkpoints are written.
+        close(self): Waits for the queued checkpoints and stops the background thread.
+    """
+
+    def __init__(self, directory, keep_last=3, weights_path=None):
+        """Initializes the manager and creates the checkpoint folder.
+
+        Args:
+            directory (str): Folder the checkpoints are written to.
+            keep_last (int): Number of most recent epoch checkpoints to keep.
+            weights_path (str, optional): Path the bare model state dict of the best checkpoint is written to.
+
+        Raises:
+            ValueError: If keep_last is smaller than 1, which would delete the checkpoint just written.
+        """
+        if keep_last < 1:
+            raise ValueError(f'keep_last must be at least 1, got {keep_last}')
+        self.directory = directory
+        self.keep_last = keep_last
+        self.weights_path = weights_path
+        self.best_path = os.path.join(directory, 'best.pt')
+        os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='checkpoint')
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def save(self, epoch, model, optimizer, scheduler, best=False, **extra):
+        """Snapshots the training state and queues it to be written.
+
+        Only the copy to the CPU happens on the calling thread, training can go
+        on while the checkpoint is serialized.
+
+        Args:
+            epoch (int): Index of the epoch that just finished.
+            model (torch.nn.Module): The model being trained.
+            optimizer (torch.optim.Optimizer): Its optimizer.
+            scheduler: Its learning rate scheduler.
+            best (bool): Whether this is the best checkpoint so far.
+            **extra: Any other picklable values to store, e.g. the loss history.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the path of the written checkpoint.
+        """
+        checkpoint = {
+            'epoch': epoch,
+            'model': _to_cpu(model.state_dict()),
+            'optimizer': _to_cpu(optimizer.state_dict()),
+            'scheduler': scheduler.state_dict() if scheduler is not None else None,
+            'rng': rng_state(),
+            'extra': _to_cpu(extra),
+        }
+        with self._lock:
+            done = [future for future in self._pending if future.done()]
+            self._pending = [future for future in self._pending if future not in done]
+            for future in done:
+                # re-raises the error of an earlier save instead of losing it
+                future.result()
+            future = self._executor.submit(self._write, checkpoint, best)
+            self._pending.append(future)
+        return future
+
+    def checkpoints(self):
+        """Lists the epoch checkpoints on disk.
+
+        Returns:
+            list: Paths of the epoch checkpoints, oldest first.
+        """
+        return sorted(glob.glob(os.path.join(self.directory, 'epoch_*.pt')))
+
+    def latest(self):
+        """Returns the most recent epoch checkpoint.
+
+        Returns:
+            str: Its path, or None if nothing was saved yet.
+        """
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def resume(self, model, optimizer, scheduler, path=None, map_location='cpu'):
+        """Restores the training state stored in a checkpoint.
+
+        Args:
+            model (torch.nn.Module): Model to load the weights into.
+            optimizer (torch.optim.Optimizer): Optimizer to restore.
+            scheduler: Learning rate scheduler to restore.
+            path (str, optional): Checkpoint to restore, the most recent one if None.
+            map_location: Device the tensors are loaded to.
+
+        Returns:
+            dict: The checkpoint's 'epoch' and 'extra' values, None if there is no checkpoint.
+        """
+        self.wait()
+        path = path or self.latest()
+        if path is None:
+            return None
+        checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if scheduler is not None and checkpoint['scheduler'] is not None:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        set_rng_state(checkpoint['rng'])
+        return {'epoch': checkpoint['epoch'], 'extra': checkpoint['extra']}
+
+    def wait(self):
+        """Blocks until every queued checkpoint is written.
+
+        Raises:
+            Exception: The first error raised while writing one.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """Writes the queued checkpoints and stops the background thread."""
+        self.wait()
+        self._executor.shutdown()
+
+    def _write(self, checkpoint, best):
+        """Serializes a checkpoint and prunes old ones, runs on the background thread.
+
+        Args:
+            checkpoint (dict): The CPU copy of the training state.
+            best (bool): Whether to also store it as the best checkpoint.
+
+        Returns:
+            str: Path of the written checkpoint.
+        """
+        path = os.path.join(self.directory, f"epoch_{checkpoint['epoch']:04d}.pt")
+        atomic_save(checkpoint, path)
+        if best:
+            shutil.copyfile(path, f'{self.best_path}.tmp')
+            os.replace(f'{self.best_path}.tmp', self.best_path)
+            if self.weights_path is not None:
+                atomic_save(checkpoint['model'], self.weights_path)
+        for old_path in self.checkpoints()[:-self.keep_last]:
+            os.remove(old_path)
+        return path
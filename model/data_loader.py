@@ -1,15 +1,65 @@
 import torch
-from torch.utils.data import DataLoader, SubsetRandomSampler
+import torch.distributed as dist
+from torch.utils.data import DataLoader, SubsetRandomSampler, DistributedSampler
 from torchvision import transforms
-from dataset_maker import load_images_and_labels, preprocess, normalization_vals, Ingredients
+from dataset_maker import load_images_and_labels, preprocess, normalization_vals, Ingredients, NORM_MEANS, NORM_STDS, build_image_cache, cache_variant_sizes, select_variant
+from inference import eval_transform
+from augment import BatchAugment
 import numpy as np
 
-def get_data(val_split=0.5):
+class DistributedSubsetSampler(DistributedSampler):
+    """Shards a fixed subset of dataset indices across the processes of a distributed run.
+
+    Every rank draws a disjoint, equally sized part of the indices, reshuffled
+    each epoch once ``set_epoch`` is called, like ``DistributedSampler`` does
+    for a whole dataset.
+
+    Methods:
+        __iter__(self): Yields this rank's dataset indices for the current epoch.
+    """
+
+    def __init__(self, indices, num_replicas, rank, shuffle=True, seed=0):
+        """Initializes the sampler.
+
+        Args:
+            indices (list): Dataset indices of the split.
+            num_replicas (int): Number of processes.
+            rank (int): Rank of this process.
+            shuffle (bool): Whether to reshuffle the indices every epoch.
+            seed (int): Seed of the shuffle, must be the same on every rank.
+        """
+        super().__init__(indices, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.indices = list(indices)
+
+    def __iter__(self):
+        """Yields this rank's dataset indices for the current epoch."""
+        return (self.indices[i] for i in super().__iter__())
+
+def get_data(val_split=0.5, cache_dir=None, batch_augment=False, input_size=32, num_workers=4, pin_memory=None,
+             persistent_workers=True, prefetch_factor=4, rank=0, world_size=1, seed=None):
     """
     Prepares DataLoader instances for training, validation, and testing splits of an image dataset.
     
     Parameters:
     - val_split (float, optional): Proportion of the training set to use for validation. Default is 0.5.
+    - cache_dir (str, optional): Folder of a memory-mapped image cache. If given, the images are decoded
+      once into it (only new or changed files on later runs) and read from it without loading them into memory.
+    - batch_augment (bool, optional): Augment whole uint8 batches as tensors when collating (see BatchAugment)
+      instead of transforming every sample as a PIL image. Default is False.
+    - input_size (int, optional): Side length of the model's input images. The images are read at the smallest
+      stored resolution that is at least this large. Default is 32.
+    - num_workers (int, optional): Number of loader worker processes per split. Default is 4.
+    - pin_memory (bool, optional): Collate batches into page-locked memory so copies to the GPU don't block.
+      Defaults to whether CUDA is available.
+    - persistent_workers (bool, optional): Keep the workers alive between epochs instead of respawning them
+      and re-opening the dataset every epoch. Default is True.
+    - prefetch_factor (int, optional): Number of batches each worker prepares ahead. Default is 4.
+    - rank (int, optional): Rank of this process in a distributed run. Default is 0.
+    - world_size (int, optional): Number of processes of a distributed run. With more than one, the train and
+      validation splits are sharded across the ranks and every rank loads batch_size images per step. The test
+      split is not sharded. Default is 1.
+    - seed (int, optional): Seed of the split shuffle. Distributed runs need the same split on every rank, so it
+      defaults to 0 there, and to numpy's global random state otherwise.
 
     Returns:
     - Tuple[DataLoader, DataLoader, DataLoader, int, int]: A tuple containing DataLoader instances for the 
@@ -17,16 +67,38 @@ def get_data(val_split=0.5):
       whose specific meaning may depend on context (e.g., number of color channels).
     """
     parent_folder = "/content/drive/MyDrive/proj_files/ingredients/ingredients"
-    images, labels = load_images_and_labels(parent_folder)
-    preprocess(images)
     transform = transforms.Compose([
         transforms.RandomHorizontalFlip(),
-        transforms.RandomResizedCrop(32),
+        transforms.RandomResizedCrop(input_size),
         transforms.ToTensor(),
-        transforms.Normalize((0.38046584, 0.10854615, -0.13485776), (0.5249659, 0.59474176, 0.6634378))
+        transforms.Normalize(NORM_MEANS, NORM_STDS)
     ])
 
-    dataset = Ingredients(images, labels, transform)
+    eval_transform_ = eval_transform(input_size)
+    train_collate, eval_collate = None, None
+    if batch_augment:
+        # samples stay uint8 arrays, the collate functions augment and normalize whole batches
+        transform, eval_transform_ = None, None
+        train_collate, eval_collate = BatchAugment(input_size, train=True), BatchAugment(input_size, train=False)
+
+    if cache_dir is not None:
+        if rank == 0:
+            build_image_cache(parent_folder, cache_dir)
+        if world_size > 1:
+            # the other ranks wait for rank 0 to finish writing the cache
+            dist.barrier()
+        side = select_variant(cache_variant_sizes(cache_dir), input_size)
+        dataset = Ingredients.from_cache(cache_dir, transform, to_pil=not batch_augment, side=side)
+        # validation and testing see the same deterministic preprocessing as the web app
+        eval_dataset = Ingredients.from_cache(cache_dir, eval_transform_, to_pil=not batch_augment, side=side)
+        labels = dataset.labels
+    else:
+        side = select_variant((32, 64, 150), input_size)
+        images, labels = load_images_and_labels(parent_folder, target_size=(side, side))
+        preprocess(images)
+        dataset = Ingredients(images, labels, transform, to_pil=not batch_augment)
+        # validation and testing see the same deterministic preprocessing as the web app
+        eval_dataset = Ingredients(images, labels, eval_transform_, to_pil=not batch_augment)
         
     batch_size = 64 # change to appropriate value for dataset in use
 
@@ -35,25 +107,46 @@ def get_data(val_split=0.5):
     train_test_split = int(np.floor(0.8 * dataset_size))
     train_val_split = int(np.floor(val_split * dataset_size))
 
-    np.random.shuffle(indices)
+    if seed is None and world_size > 1:
+        seed = 0
+    if seed is None:
+        np.random.shuffle(indices)
+    else:
+        np.random.RandomState(seed).shuffle(indices)
 
     train_idx, test_idx = indices[train_test_split:], indices[:train_test_split]
     val_idx = train_idx[:train_val_split]
 
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    loader_options = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0:
+        # only valid with worker processes
+        loader_options.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+
+    if world_size > 1:
+        train_sampler = DistributedSubsetSampler(train_idx, world_size, rank, seed=seed)
+        val_sampler = DistributedSubsetSampler(val_idx, world_size, rank, seed=seed)
+    else:
+        train_sampler, val_sampler = SubsetRandomSampler(train_idx), SubsetRandomSampler(val_idx)
+
     train_loader = DataLoader(dataset,
                               batch_size=batch_size,
-                              sampler=SubsetRandomSampler(train_idx),
-                              num_workers=4) 
+                              sampler=train_sampler,
+                              collate_fn=train_collate,
+                              **loader_options) 
     
-    test_loader = DataLoader(dataset,
+    test_loader = DataLoader(eval_dataset,
                              batch_size=batch_size,
                              sampler=SubsetRandomSampler(test_idx),
-                             num_workers=4) 
+                             collate_fn=eval_collate,
+                             **loader_options) 
 
-    val_loader = DataLoader(dataset,
+    val_loader = DataLoader(eval_dataset,
                             batch_size=batch_size,
-                            sampler=SubsetRandomSampler(val_idx),
-                            num_workers=4) 
+                            sampler=val_sampler,
+                            collate_fn=eval_collate,
+                            **loader_options) 
     
     return train_loader, val_loader, test_loader, len(np.unique(labels)), 3
 
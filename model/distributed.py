@@ -0,0 +1,110 @@
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    """Returns whether this process is part of an initialized process group.
+
+    Returns:
+        bool: True inside a run started by launch.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """Returns the rank of this process, 0 when not distributed.
+
+    Returns:
+        int: The rank.
+    """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """Returns the number of training processes, 1 when not distributed.
+
+    Returns:
+        int: The world size.
+    """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Returns whether this process logs, plots and writes checkpoints.
+
+    Returns:
+        bool: True on rank 0 and when not distributed.
+    """
+    return get_rank() == 0
+
+
+def all_reduce_mean(value, device=torch.device('cpu')):
+    """Averages a number over all processes.
+
+    Args:
+        value (float): This process's value.
+        device (torch.device): Device the backend communicates on.
+
+    Returns:
+        float: The mean over all processes, value itself when not distributed.
+    """
+    if not is_distributed():
+        return value
+    tensor = torch.tensor(float(value), device=device)
+    dist.all_reduce(tensor)
+    return tensor.item() / get_world_size()
+
+
+def init_process(rank, world_size, backend='gloo', master_addr='127.0.0.1', master_port=29500, num_threads=None):
+    """Joins the process group of a single-node run.
+
+    Args:
+        rank (int): Rank of this process.
+        world_size (int): Number of processes.
+        backend (str): torch.distributed backend, gloo works on CPU.
+        master_addr (str): Address of the rank 0 process.
+        master_port (int): Port rank 0 listens on.
+        num_threads (int, optional): Intra-op threads of this process, the cores divided by world_size if None.
+    """
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    # without this every process would start a thread per core and oversubscribe the machine
+    torch.set_num_threads(num_threads or max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def _run(rank, fn, world_size, backend, master_port, args):
+    """Entry point of every spawned process.
+
+    Args:
+        rank (int): Rank of this process, passed by torch.multiprocessing.spawn.
+        fn (callable): Called as fn(rank, world_size, *args) once the group is initialized.
+        world_size (int): Number of processes.
+        backend (str): torch.distributed backend.
+        master_port (int): Port rank 0 listens on.
+        args (tuple): Extra arguments of fn.
+    """
+    init_process(rank, world_size, backend, master_port=master_port)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, world_size, *args, backend='gloo', master_port=29500):
+    """Runs fn in world_size processes on this machine, joined in one process group.
+
+    Args:
+        fn (callable): Module-level function called as fn(rank, world_size, *args) in every process.
+        world_size (int): Number of processes, fn runs in this process without a group if 1.
+        *args: Extra arguments of fn, must be picklable.
+        backend (str): torch.distributed backend, gloo works on CPU.
+        master_port (int): Port rank 0 listens on.
+    """
+    if world_size == 1:
+        fn(0, 1, *args)
+        return
+    mp.spawn(_run, args=(fn, world_size, backend, master_port, args), nprocs=world_size, join=True)
@@ -6,7 +6,7 @@ class Logger(object):
 
     Methods:
         __init__(self): Initializes the Logger object.
-        set_logger(self, log_path): Configures the logger to log messages to a file and console.
+        set_logger(self, log_path, rank=0, append=False): Configures the logger to log messages to a file and console.
     """
     
     def __init__(self):
@@ -15,18 +15,31 @@ class Logger(object):
         """
         pass
     
-    def set_logger(self, log_path):
+    def set_logger(self, log_path, rank=0, append=False):
         """Configures the logger to log messages to a file and console.
 
+        In a distributed run only rank 0 writes the log, the other ranks just
+        print warnings and errors.
+
         Args:
             log_path (str): Path to the log file.
+            rank (int): Rank of this process. Default is 0.
+            append (bool): Append to an existing log instead of starting a new one. Default is False.
 
         Returns:
             None
         """
-        if os.path.exists(log_path) is True:
-           os.remove(log_path)
         self.logger = logging.getLogger()
+        if rank != 0:
+            self.logger.setLevel(logging.WARNING)
+            if not self.logger.handlers:
+                stream_handler = logging.StreamHandler()
+                stream_handler.setFormatter(logging.Formatter(f'[rank {rank}] %(message)s'))
+                self.logger.addHandler(stream_handler)
+            return
+
+        if not append and os.path.exists(log_path) is True:
+           os.remove(log_path)
         self.logger.setLevel(logging.INFO)
     
         if not self.logger.handlers:
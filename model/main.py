@@ -1,34 +1,70 @@
+import argparse
+
 import torch
 import torch.optim as optim
 # from torchinfo import summary
 
 from logger import Logger
 from train import run_epoch
-from resnet import resnet14, resnet18, resnet34, resnet50
+from checkpoint import CheckpointManager
+from resnet import resnet18, resnet34, resnet50
 from data_loader import get_data
 from test import run_test
+from distributed import launch
 
 torch.manual_seed(0)
 
 EPOCHS = 100
-EARLY_STOP = 5
+EARLY_STOP = 5 # validations without improvement before stopping
+MIN_DELTA = 0.0001
+VAL_EVERY = 1
+VAL_BATCHES = None # validate on a subset of the val batches to save time
 LR = 0.1
 MOMENTUM = 0.9
 WEIGHT_DECAY = 0.0005 # 0.0005 test
 VAL_SPLIT = 0.1
+PERFORMANCE = False # opt in to bfloat16/float16 autocast and channels_last
+COMPILE = False # torch.compile the model, pays off on long runs
+KEEP_CHECKPOINTS = 3
+RESUME = False # opt in to continuing from the last checkpoint of an interrupted run
+NUM_PROCESSES = 1 # training processes on this machine, each gets a shard of the data and its share of the cores
 
 model_save_path = f'./model_logs/Ingredients1'
 
-log = Logger()
-log.set_logger(f'{model_save_path}.log')
+def main(rank=0, world_size=1, resume=RESUME):
+    """Trains and tests the model, in one process of a distributed run if world_size > 1.
+
+    Args:
+        rank (int): Rank of this process.
+        world_size (int): Number of training processes.
+        resume (bool): Continue from the last checkpoint and append to its log.
+    """
+    log = Logger()
+    # a resumed run keeps the log of the epochs it continues from
+    log.set_logger(f'{model_save_path}.log', rank, append=resume)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    train_loader, val_loader, test_loader, num_classes, num_channels = get_data(VAL_SPLIT, rank=rank, world_size=world_size)
+    model = resnet18(num_classes, num_channels)
+    optimizer = optim.SGD(model.parameters(), LR, MOMENTUM, weight_decay=WEIGHT_DECAY)
+    # scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=200)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=20, gamma=0.1)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-train_loader, val_loader, test_loader, num_classes, num_channels = get_data(VAL_SPLIT)
-model = resnet18(num_classes, num_channels)
-optimizer = optim.SGD(model.parameters(), LR, MOMENTUM, weight_decay=WEIGHT_DECAY)
-# scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=200)
-scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=20, gamma=0.1)
+    checkpoints = CheckpointManager(f'{model_save_path}_checkpoints', KEEP_CHECKPOINTS, f'{model_save_path}.pth')
+    run_epoch(model, train_loader, val_loader, optimizer, scheduler, EPOCHS, EARLY_STOP, f'{model_save_path}.pth', device, log,
+              performance=PERFORMANCE, compile=COMPILE, checkpoints=checkpoints, resume=resume,
+              min_delta=MIN_DELTA, val_every=VAL_EVERY, val_batches=VAL_BATCHES)
+    checkpoints.close()
+    if rank == 0:
+        accuracy = run_test(model, test_loader, device, f"{model_save_path}.pth")
+        log.logger.info("Accuracy: {:.10f}".format(accuracy))
 
-run_epoch(model, train_loader, val_loader, optimizer, scheduler, EPOCHS, EARLY_STOP, f'{model_save_path}.pth', device, log)
-accuracy = run_test(model, test_loader, device, f"{model_save_path}.pth")
-log.logger.info("Accuracy: {:.10f}".format(accuracy))
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the ingredient classifier.')
+    parser.add_argument('--nproc', type=int, default=NUM_PROCESSES,
+                        help='number of training processes on this machine (gloo backend)')
+    parser.add_argument('--port', type=int, default=29500, help='port the processes rendezvous on')
+    parser.add_argument('--resume', action='store_true', default=RESUME,
+                        help='continue from the last checkpoint of an interrupted run')
+    args = parser.parse_args()
+    launch(main, args.nproc, args.resume, master_port=args.port)
@@ -1,33 +1,161 @@
 import torch
-from sklearn.metrics import precision_recall_fscore_support, accuracy_score
 
-def run_test(model, test_loader, device, model_save_path):
+
+class Evaluator(object):
+    """Accumulates classification metrics batch by batch in constant memory.
+
+    Only a confusion matrix and per-k counts of top-k hits are kept, as
+    tensors on the evaluation device, so the predictions are never copied
+    into Python lists and the size of the test set doesn't matter.
+
+    Args:
+        num_classes (int, optional): Number of classes, taken from the first batch of outputs if None.
+        top_k (tuple): Values of k to report top-k accuracy for, those above num_classes are dropped.
+        device (torch.device): Device the counts are kept on.
+
+    Methods:
+        update(self, outputs, labels): Adds a batch of model outputs and labels.
+        compute(self): Returns the metrics of everything added so far.
+    """
+
+    def __init__(self, num_classes=None, top_k=(1, 5), device=torch.device('cpu')):
+        """Initializes empty counts.
+
+        Args:
+            num_classes (int, optional): Number of classes, taken from the first batch of outputs if None.
+            top_k (tuple): Values of k to report top-k accuracy for, those above num_classes are dropped.
+            device (torch.device): Device the counts are kept on.
+        """
+        self.num_classes = num_classes
+        self.top_k = tuple(top_k)
+        if num_classes is not None:
+            self._drop_unreachable_k()
+        self.device = device
+        self.confusion = None
+        self.top_k_correct = None
+
+    def _drop_unreachable_k(self):
+        """Drops the values of k above the number of classes, their top-k accuracy would always be 1."""
+        self.top_k = tuple(k for k in self.top_k if k <= self.num_classes)
+
+    def update(self, outputs, labels):
+        """Adds a batch of model outputs and labels.
+
+        Args:
+            outputs (torch.Tensor): Scores of shape (N, num_classes).
+            labels (torch.Tensor): True classes of shape (N,).
+        """
+        if self.confusion is None:
+            if self.num_classes is None:
+                self.num_classes = outputs.shape[1]
+                self._drop_unreachable_k()
+            self.confusion = torch.zeros(self.num_classes, self.num_classes, dtype=torch.int64, device=self.device)
+            self.top_k_correct = torch.zeros(len(self.top_k), dtype=torch.int64, device=self.device)
+        labels = labels.to(self.device)
+        outputs = outputs.to(self.device)
+        predictions = outputs.argmax(1)
+        # row is the true class, column the predicted one
+        self.confusion += torch.bincount(labels * self.num_classes + predictions,
+                                         minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+        if self.top_k:
+            ranked = outputs.topk(max(self.top_k), dim=1).indices
+            hits = ranked == labels.unsqueeze(1)
+            for i, k in enumerate(self.top_k):
+                self.top_k_correct[i] += hits[:, :k].any(1).sum()
+
+    def compute(self):
+        """Returns the metrics of everything added so far.
+
+        Returns:
+            dict: 'accuracy', per-class 'precision', 'recall', 'f1' and 'support' lists,
+                'top_k' accuracies by k and the 'confusion_matrix' (rows are true classes).
+
+        Raises:
+            ValueError: If no batch has been added.
+        """
+        if self.confusion is None:
+            raise ValueError('no batches were added, there is nothing to compute metrics of')
+        confusion = self.confusion.double()
+        true_positives = confusion.diag()
+        support = confusion.sum(1)
+        predicted = confusion.sum(0)
+        total = support.sum()
+        # classes that are never predicted (or never occur) get 0, like sklearn's zero_division=0
+        precision = torch.where(predicted > 0, true_positives / predicted.clamp(min=1), torch.zeros_like(predicted))
+        recall = torch.where(support > 0, true_positives / support.clamp(min=1), torch.zeros_like(support))
+        denominator = precision + recall
+        f1 = torch.where(denominator > 0, 2 * precision * recall / denominator.clamp(min=1e-12), torch.zeros_like(denominator))
+        return {
+            'accuracy': (true_positives.sum() / total).item(),
+            'precision': precision.tolist(),
+            'recall': recall.tolist(),
+            'f1': f1.tolist(),
+            'support': support.long().tolist(),
+            'top_k': {k: (correct / total).item() for k, correct in zip(self.top_k, self.top_k_correct.double())},
+            'confusion_matrix': self.confusion.tolist(),
+        }
+
+
+def evaluate(models, test_loader, device, num_classes=None, top_k=(1, 5)):
+    """Evaluates several models in a single pass over the test data.
+
+    Each batch is loaded and moved to the device once and run through every model.
+
+    Args:
+        models (dict): Models in eval mode by name.
+        test_loader (torch.utils.data.DataLoader): DataLoader containing the test data.
+        device (torch.device): The device to be used for testing (cuda or cpu).
+        num_classes (int, optional): Number of classes, taken from the model outputs if None.
+        top_k (tuple): Values of k to report top-k accuracy for.
+
+    Returns:
+        dict: Metrics of every model as returned by Evaluator.compute, by name.
+    """
+    evaluators = {name: Evaluator(num_classes, top_k, device) for name in models}
+    with torch.inference_mode():
+        for images, labels in test_loader:
+            images, labels = images.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+            for name, model in models.items():
+                evaluators[name].update(model(images), labels)
+    return {name: evaluator.compute() for name, evaluator in evaluators.items()}
+
+
+def evaluate_checkpoints(build_model, checkpoint_paths, test_loader, device, num_classes=None, top_k=(1, 5)):
+    """Evaluates several saved checkpoints of one architecture in a single pass over the test data.
+
+    Args:
+        build_model (callable): Returns a fresh model to load a state dict into.
+        checkpoint_paths (list): Paths to the saved state dicts.
+        test_loader (torch.utils.data.DataLoader): DataLoader containing the test data.
+        device (torch.device): The device to be used for testing (cuda or cpu).
+        num_classes (int, optional): Number of classes, taken from the model outputs if None.
+        top_k (tuple): Values of k to report top-k accuracy for.
+
+    Returns:
+        dict: Metrics of every checkpoint as returned by Evaluator.compute, by path.
+    """
+    models = {}
+    for path in checkpoint_paths:
+        model = build_model()
+        model.load_state_dict(torch.load(path, map_location=device))
+        models[path] = model.to(device).eval()
+    return evaluate(models, test_loader, device, num_classes, top_k)
+
+
+def run_test(model, test_loader, device, model_save_path=None):
     """Run testing on the test data using the trained model.
 
     Args:
         model (torch.nn.Module): The trained model.
         test_loader (torch.utils.data.DataLoader): DataLoader containing the test data.
         device (torch.device): The device to be used for testing (cuda or cpu).
-        model_save_path (str): Path to the saved model.
+        model_save_path (str, optional): Path to the saved model, if None the model is tested as is.
 
     Returns:
         float: Accuracy achieved by the model on the test data.
     """
-    model.load_state_dict(torch.load(model_save_path))
+    if model_save_path is not None:
+        model.load_state_dict(torch.load(model_save_path, map_location=device))
     model.to(device)
     model.eval()
-
-    all_labels = []
-    all_predictions = []
-
-    with torch.no_grad():
-        for images, labels in test_loader:
-            images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
-            _, predictions = torch.max(outputs, 1)
-            all_labels.extend(labels.cpu().numpy())
-            all_predictions.extend(predictions.cpu().numpy())
-
-    accuracy = accuracy_score(all_labels, all_predictions)
-
-    return accuracy
+    return evaluate({'model': model}, test_loader, device, top_k=(1,))['model']['accuracy']
@@ -1,8 +1,46 @@
+import contextlib
+import itertools
+import time
+
 import torch
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 import matplotlib.pyplot as plt
 
-def train(model, train_loader, optimizer, device):
+from distributed import all_reduce_mean, get_world_size, is_distributed, is_main_process
+
+def autocast(device, enabled=True):
+    """Returns the mixed precision context for the given device.
+
+    Args:
+        device (torch.device): The device the model runs on.
+        enabled (bool): Whether to use mixed precision at all.
+
+    Returns:
+        context manager: float16 autocast on CUDA, bfloat16 autocast on CPU, or a no-op.
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device.type, dtype=dtype)
+
+def to_device(data, target, device, channels_last=False):
+    """Moves a batch to the device without blocking on pinned memory.
+
+    Args:
+        data (torch.Tensor): Batch of images.
+        target (torch.Tensor): Batch of labels.
+        device (torch.device): The device to move them to.
+        channels_last (bool): Whether to lay the images out channels last.
+
+    Returns:
+        tuple: The images and labels on the device.
+    """
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    data = data.to(device, non_blocking=True, memory_format=memory_format)
+    return data, target.to(device, non_blocking=True)
+
+def train(model, train_loader, optimizer, device, performance=False, scaler=None):
     """Train the given model using the provided data loader and optimizer.
 
     Args:
@@ -10,45 +48,59 @@ def train(model, train_loader, optimizer, device):
         train_loader (torch.utils.data.DataLoader): DataLoader containing the training data.
         optimizer (torch.optim.Optimizer): The optimizer to update the model's parameters.
         device (torch.device): The device to be used for training (e.g., 'cuda' or 'cpu').
+        performance (bool): Whether to train with mixed precision on channels_last batches.
+        scaler (torch.amp.GradScaler, optional): Scales the float16 loss on CUDA.
 
     Returns:
         float: The average loss over all batches for the current epoch.
     """
-    epoch_loss = 0.0
+    # summed on the device, read back once per epoch instead of syncing every batch
+    epoch_loss = torch.zeros((), device=device)
     model.train()
     for batch_idx, (data, target) in enumerate(train_loader):
-        data, target = data.to(device), target.to(device)
-        optimizer.zero_grad()
-        output = model(data)
-        loss = F.cross_entropy(output, target, reduction='mean')
-        loss.backward()
-        optimizer.step()
-        epoch_loss += loss.item()
+        data, target = to_device(data, target, device, channels_last=performance)
+        optimizer.zero_grad(set_to_none=True)
+        with autocast(device, performance):
+            output = model(data)
+            loss = F.cross_entropy(output, target, reduction='mean')
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
+        epoch_loss += loss.detach().float()
     epoch_loss /= len(train_loader)
-    return epoch_loss
+    return epoch_loss.item()
 
-def val(model, val_loader, device):
+def val(model, val_loader, device, performance=False, max_batches=None):
     """Validate the given model using the provided data loader.
 
     Args:
         model (torch.nn.Module): The model to be validated.
         val_loader (torch.utils.data.DataLoader): DataLoader containing the validation data.
         device (torch.device): The device to be used for validation (cuda or cpu).
+        performance (bool): Whether to validate with mixed precision on channels_last batches.
+        max_batches (int, optional): Only validate on this many batches, a random subset with a shuffling sampler.
 
     Returns:
         float: The loss over one iteration using the trained model.
     """
     model.eval()
-    test_loss = 0.0
+    test_loss = torch.zeros((), device=device)
+    num_batches = 0
     with torch.no_grad():
-        for batch_idx, (data, target) in enumerate(val_loader):
-            data, target = data.to(device), target.to(device)
-            output = model(data)
-            test_loss += F.cross_entropy(output, target, reduction='mean')
-        test_loss /= len(val_loader)
-        return test_loss
+        for data, target in itertools.islice(val_loader, max_batches):
+            data, target = to_device(data, target, device, channels_last=performance)
+            with autocast(device, performance):
+                output = model(data)
+                test_loss += F.cross_entropy(output, target, reduction='mean').float()
+            num_batches += 1
+        test_loss /= num_batches
+        return test_loss.item()
 
-def run_epoch(model:torch.nn.Module, train_loader:torch.utils.data.DataLoader, val_loader:torch.utils.data.DataLoader, optimizer, scheduler, epochs:int, early_stop:int, model_save_path:str, device:torch.device, log, loading=False):
+def run_epoch(model:torch.nn.Module, train_loader:torch.utils.data.DataLoader, val_loader:torch.utils.data.DataLoader, optimizer, scheduler, epochs:int, early_stop:int, model_save_path:str, device:torch.device, log, loading=False, performance=False, compile=False, checkpoints=None, resume=False, min_delta=0.0, val_every=1, val_batches=None):
     """Run training and validation for the given number of epochs.
 
     Args:
@@ -58,55 +110,146 @@ def run_epoch(model:torch.nn.Module, train_loader:torch.utils.data.DataLoader, v
         optimizer: The optimizer to update the model's parameters.
         scheduler: Learning rate scheduler.
         epochs (int): Number of epochs for training.
-        early_stop (int): Number of epochs to wait before early stopping if validation loss doesn't improve.
+        early_stop (int): Number of validations without improvement before training stops, None to never stop early.
         model_save_path (str): Path to save the best model.
         device (torch.device): Device to be used for training (cuda or cpu).
         log: Logger object for logging.
         loading (bool): Flag indicating whether to load a pre-trained model. Default is False.
+        performance (bool): Train with mixed precision (bfloat16 on CPU, float16 with loss scaling on CUDA)
+            and channels_last batches. Default is False.
+        compile (bool): Run the forward and backward passes through torch.compile. Default is False.
+        checkpoints (CheckpointManager, optional): Writes a resumable checkpoint after every epoch in the
+            background. The best model is still written to model_save_path. Default is None.
+        resume (bool): Continue from the most recent checkpoint of checkpoints, restoring the optimizer,
+            scheduler, random number generators, epoch, loss history and early stopping state. Default is False.
+        min_delta (float): Smallest decrease of the validation loss that counts as an improvement. Default is 0.
+        val_every (int): Validate every this many epochs, and after the last one. Default is 1.
+        val_batches (int, optional): Validate on this many batches only instead of the whole val_loader,
+            at least 1.
+
+    Inside a distributed run (see ``distributed.launch``) the model is wrapped in
+    DistributedDataParallel so gradients are all-reduced every step, losses are
+    averaged over the ranks so all of them stop at the same epoch, and only rank
+    0 saves the model, writes checkpoints and plots.
 
     Returns:
-        None
+        dict: Epochs run, best epoch and validation loss, whether training stopped early, and the
+            wall time it took and (estimated from the mean epoch time) saved.
+
+    Raises:
+        ValueError: If val_batches is less than 1.
     """
+    # checked before any epoch runs, the validation loss is a mean over the batches
+    if val_batches is not None and val_batches < 1:
+        raise ValueError(f'val_batches must be at least 1 or None, got {val_batches}')
     train_losses = []
     val_losses = []
+    # epoch of every entry of val_losses
+    val_epochs = []
     if loading==True:
         model.load_state_dict(torch.load(model_save_path))
         log.logger.info("-------------Model Loaded------------")
         
-    best_loss=0
-    #curr_early_stop = early_stop
+    best_loss = float('inf')
+    best_epoch = None
+    curr_early_stop = early_stop
+    start_epoch = 0
+    # move the model first, load_state_dict then casts the restored optimizer state to the parameters' device
     model.to(device)
-    for epoch in range(epochs):
-        train_loss = train(model, train_loader, optimizer, device)
-        val_loss = val(model, val_loader, device)
+    if performance:
+        model.to(memory_format=torch.channels_last)
+    if checkpoints is not None and resume:
+        state = checkpoints.resume(model, optimizer, scheduler)
+        if state is not None:
+            start_epoch = state['epoch'] + 1
+            extra = state['extra']
+            best_loss, best_epoch = extra['best_loss'], extra['best_epoch']
+            curr_early_stop = extra['curr_early_stop']
+            train_losses, val_losses, val_epochs = extra['train_losses'], extra['val_losses'], extra['val_epochs']
+            log.logger.info(f"------------- Resumed after epoch {start_epoch} ------------")
+    scaler = torch.amp.GradScaler('cuda') if performance and device.type == 'cuda' else None
+    step_model = model
+    if is_distributed():
+        step_model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+    # the compiled module shares its parameters with model, which is still what gets saved
+    if compile:
+        step_model = torch.compile(step_model)
+    save = is_main_process()
+    num_images = len(train_loader.sampler) * get_world_size()
+    run_start = time.perf_counter()
+    epochs_run = 0
+    stopped_early = False
+    for epoch in range(start_epoch, epochs):
+        for loader in (train_loader, val_loader):
+            if hasattr(loader.sampler, 'set_epoch'):
+                # reshuffles the shards of a distributed sampler
+                loader.sampler.set_epoch(epoch)
+        start = time.perf_counter()
+        train_loss = all_reduce_mean(train(step_model, train_loader, optimizer, device, performance, scaler), device)
+        throughput = num_images / (time.perf_counter() - start)
+        train_losses.append(train_loss)
         scheduler.step()
-       
-        log.logger.info((f"Epoch: {epoch+1} - loss: {train_loss:.10f} - test_loss: {val_loss:.10f}"))
+        epochs_run += 1
 
-        train_losses.append(train_loss)
+        if (epoch + 1) % val_every != 0 and epoch + 1 != epochs:
+            log.logger.info(f"Epoch: {epoch+1} - loss: {train_loss:.10f} - {throughput:.1f} images/sec")
+            if checkpoints is not None and save:
+                checkpoints.save(epoch, model, optimizer, scheduler, best=False, best_loss=best_loss, best_epoch=best_epoch,
+                                 curr_early_stop=curr_early_stop, train_losses=train_losses, val_losses=val_losses,
+                                 val_epochs=val_epochs)
+            continue
+
+        val_loss = all_reduce_mean(val(step_model, val_loader, device, performance, val_batches), device)
+        log.logger.info((f"Epoch: {epoch+1} - loss: {train_loss:.10f} - test_loss: {val_loss:.10f} - {throughput:.1f} images/sec"))
         val_losses.append(val_loss)
-        
-        if epoch == 0:
-            best_loss=val_loss
-        if val_loss<=best_loss:
-            torch.save(model.state_dict(), model_save_path)    
-            best_loss=val_loss
+        val_epochs.append(epoch)
+
+        improved = val_loss < best_loss - min_delta
+        if improved:
+            if checkpoints is None and save:
+                torch.save(model.state_dict(), model_save_path)    
+            best_loss = val_loss
+            best_epoch = epoch
             log.logger.info("-------- Save Best Model! --------")
-            #curr_early_stop = early_stop
-        #else:
-            #curr_early_stop-=1
-            #log.logger.info("Early Stop Left: {}".format(curr_early_stop))
-        #if curr_early_stop == 0:
-            #log.logger.info("-------- Early Stop! --------")
-            #break
+            curr_early_stop = early_stop
+        elif early_stop is not None:
+            curr_early_stop -= 1
+            log.logger.info("Early Stop Left: {}".format(curr_early_stop))
+        if checkpoints is not None and save:
+            checkpoints.save(epoch, model, optimizer, scheduler, best=improved, best_loss=best_loss, best_epoch=best_epoch,
+                             curr_early_stop=curr_early_stop, train_losses=train_losses, val_losses=val_losses,
+                             val_epochs=val_epochs)
+        if curr_early_stop is not None and curr_early_stop <= 0:
+            log.logger.info("-------- Early Stop! --------")
+            stopped_early = True
+            break
+    if checkpoints is not None:
+        checkpoints.wait()
+
+    wall_time = time.perf_counter() - run_start
+    epoch_time = wall_time / epochs_run if epochs_run else 0.0
+    summary = {
+        'epochs_run': start_epoch + epochs_run,
+        'best_epoch': None if best_epoch is None else best_epoch + 1,
+        'best_loss': best_loss,
+        'stopped_early': stopped_early,
+        'wall_time': wall_time,
+        'time_saved': epoch_time * (epochs - start_epoch - epochs_run),
+    }
+    log.logger.info(f"Trained {summary['epochs_run']}/{epochs} epochs in {wall_time:.1f}s, "
+                    f"best test_loss {best_loss:.10f} at epoch {summary['best_epoch']}, "
+                    f"~{summary['time_saved']:.1f}s saved by stopping early")
+    if not save:
+        return summary
     
     # visualize train and val loss
     train_losses = torch.tensor(train_losses)  
     val_losses = torch.tensor(val_losses)
     plt.plot(train_losses.cpu(), label='Train Loss') 
-    plt.plot(val_losses.cpu(), label='Validation Loss')  
+    plt.plot(val_epochs, val_losses.cpu(), label='Validation Loss')  
     plt.xlabel('Epoch')
     plt.ylabel('Loss')
     plt.legend()
     plt.title('Train and Validation Loss')
-    plt.show()
\ No newline at end of file
+    plt.show()
+    return summary
@@ -0,0 +1,165 @@
+"""Exports trained ResNet checkpoints as inference-optimized TorchScript.
+
+The exported model has every BatchNorm folded into the convolution before it,
+conv+BN+ReLU runs fused into single modules, weights in channels_last layout,
+and the trailing sigmoid dropped (it doesn't change the argmax). The result is
+traced, frozen and saved so the web app can load it through the model registry
+without rebuilding anything. ``check_parity`` verifies the export predicts the
+same classes as the eager model on a fixed set of inputs.
+
+Usage:
+    python model_export.py model/model_logs/Ingredients8.pth model/model_logs/Ingredients8.scripted.pt
+"""
+
+import argparse
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import fuse_modules
+
+from resnet import BasicBlock, BottleNeck, resnet18, resnet34, resnet50, resnet101, resnet152
+
+ARCHITECTURES = {
+    'resnet18': resnet18,
+    'resnet34': resnet34,
+    'resnet50': resnet50,
+    'resnet101': resnet101,
+    'resnet152': resnet152,
+}
+
+
+def fusion_groups(model):
+    """Lists the conv/BN/ReLU module names of a ResNet that can be fused.
+
+    Args:
+        model (ResNet): Model to fuse.
+
+    Returns:
+        list: Lists of module names, each fused into one module.
+    """
+    groups = [['conv1.0', 'conv1.1', 'conv1.2']]
+    for name, module in model.named_modules():
+        if isinstance(module, BasicBlock):
+            groups.append([f'{name}.residual_function.{i}' for i in (0, 1, 2)])
+            groups.append([f'{name}.residual_function.{i}' for i in (3, 4)])
+        elif isinstance(module, BottleNeck):
+            groups.append([f'{name}.residual_function.{i}' for i in (0, 1, 2)])
+            groups.append([f'{name}.residual_function.{i}' for i in (3, 4, 5)])
+            groups.append([f'{name}.residual_function.{i}' for i in (6, 7)])
+        else:
+            continue
+        if len(module.shortcut) > 0:
+            groups.append([f'{name}.shortcut.0', f'{name}.shortcut.1'])
+    return groups
+
+
+def fuse_resnet(model):
+    """Returns an eval-mode copy of a ResNet with BatchNorm folded and conv+ReLU fused.
+
+    Args:
+        model (ResNet): Trained model, left untouched.
+
+    Returns:
+        ResNet: Fused copy that outputs logits instead of sigmoid scores.
+    """
+    fused = copy.deepcopy(model).eval()
+    fused = fuse_modules(fused, fusion_groups(fused))
+    # monotonic, so argmax over the logits is the same
+    fused.sigmoid = nn.Identity()
+    return fused
+
+
+def optimize(model, size=32):
+    """Builds the frozen, channels_last TorchScript version of a ResNet.
+
+    Args:
+        model (ResNet): Trained model, left untouched.
+        size (int): Side length of the model's input images.
+
+    Returns:
+        torch.jit.ScriptModule: The optimized model.
+    """
+    fused = fuse_resnet(model).to(memory_format=torch.channels_last)
+    example = torch.zeros(1, 3, size, size).to(memory_format=torch.channels_last)
+    with torch.no_grad():
+        scripted = torch.jit.trace(fused, example)
+        # optimize_for_inference would add MKLDNN ops that don't survive torch.jit.save
+        scripted = torch.jit.freeze(scripted.eval())
+    return scripted
+
+
+def parity_inputs(n=64, size=32, seed=0):
+    """Returns the fixed batch the exported model is checked on.
+
+    Args:
+        n (int): Number of images.
+        size (int): Side length of the images.
+        seed (int): Seed of the generator producing them.
+
+    Returns:
+        torch.Tensor: Batch of shape (n, 3, size, size).
+    """
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(n, 3, size, size, generator=generator)
+
+
+def check_parity(model, exported, inputs, atol=1e-4):
+    """Checks that an exported model matches the eager one.
+
+    Args:
+        model (ResNet): Eager model in eval mode.
+        exported (callable): Exported model returning logits.
+        inputs (torch.Tensor): Batch to compare on.
+        atol (float): Largest allowed difference between the sigmoid scores.
+
+    Returns:
+        dict: Fraction of matching predictions and largest score difference.
+
+    Raises:
+        AssertionError: If a prediction differs or a score is off by more than atol.
+    """
+    model.eval()
+    with torch.no_grad():
+        expected = model(inputs)
+        actual = torch.sigmoid(exported(inputs))
+    agreement = (expected.argmax(1) == actual.argmax(1)).float().mean().item()
+    max_diff = (expected - actual).abs().max().item()
+    assert agreement == 1.0, f'exported model disagrees on {1 - agreement:.2%} of the inputs'
+    assert max_diff <= atol, f'exported scores differ by up to {max_diff:.2e}'
+    return {'agreement': agreement, 'max_diff': max_diff}
+
+
+def export(checkpoint_path, output_path, arch='resnet18', num_classes=4, num_channels=3, size=32):
+    """Loads a checkpoint, optimizes it, checks parity and saves the TorchScript artifact.
+
+    Args:
+        checkpoint_path (str): Path to the trained state dict.
+        output_path (str): Path the TorchScript model is saved to.
+        arch (str): Name of the ResNet the checkpoint belongs to.
+        num_classes (int): Number of output classes.
+        num_channels (int): Number of input channels.
+        size (int): Side length of the model's input images.
+
+    Returns:
+        dict: Result of the parity check.
+    """
+    model = ARCHITECTURES[arch](num_classes, num_channels)
+    model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+    model.eval()
+    scripted = optimize(model, size)
+    parity = check_parity(model, scripted, parity_inputs(size=size))
+    torch.jit.save(scripted, output_path)
+    return parity
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a trained ResNet as optimized TorchScript.')
+    parser.add_argument('checkpoint', help='path to the trained state dict')
+    parser.add_argument('output', help='path to save the TorchScript model to')
+    parser.add_argument('--arch', default='resnet18', choices=sorted(ARCHITECTURES))
+    parser.add_argument('--num-classes', type=int, default=4)
+    parser.add_argument('--size', type=int, default=32)
+    args = parser.parse_args()
+    parity = export(args.checkpoint, args.output, args.arch, args.num_classes, size=args.size)
+    print(f"Saved {args.output} (agreement {parity['agreement']:.2%}, max diff {parity['max_diff']:.2e})")
@@ -0,0 +1,114 @@
+"""Process-wide registry of the models served by the web app.
+
+Each named checkpoint is built and deserialized once, put in eval mode and
+shared by every request thread. The checkpoint file is re-stat'ed on access
+and the model is transparently reloaded when its mtime changes, so a new
+``.pth`` can be dropped into ``model/model_logs`` without restarting gunicorn.
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+import torch
+
+
+class LoadedModel(namedtuple('LoadedModel', ['model', 'path', 'mtime_ns'])):
+    """A loaded model together with the checkpoint it came from."""
+
+    __slots__ = ()
+
+    @property
+    def version(self):
+        """str: ``path@mtime_ns``, changes whenever the checkpoint is replaced."""
+        return f'{self.path}@{self.mtime_ns}'
+
+
+class ModelRegistry(object):
+    """Thread-safe registry of lazily loaded, hot-reloadable models.
+
+    Methods:
+        register(self, name, path, builder=None): Registers a checkpoint under a name.
+        get(self, name): Returns the loaded model, reloading it if the checkpoint changed.
+        version(self, name): Returns an identifier of the checkpoint currently loaded.
+        preload(self): Loads every registered model up front.
+    """
+
+    def __init__(self):
+        """Initializes an empty registry."""
+        self._specs = {}
+        self._loaded = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, path, builder=None):
+        """Registers a checkpoint under the given name.
+
+        Args:
+            name (str): Name the model is looked up by.
+            path (str): Path to the checkpoint file.
+            builder (callable, optional): Returns a fresh ``nn.Module`` to load the
+                state dict into. If None, the checkpoint is loaded as TorchScript.
+        """
+        with self._lock:
+            self._specs[name] = (path, builder)
+            self._locks[name] = threading.Lock()
+            self._loaded.pop(name, None)
+
+    def get(self, name):
+        """Returns the model registered under name, loading it on first use.
+
+        Args:
+            name (str): Name the model was registered under.
+
+        Returns:
+            LoadedModel: The model in eval mode along with its checkpoint path and mtime.
+        """
+        path, builder = self._specs[name]
+        mtime_ns = os.stat(path).st_mtime_ns
+        loaded = self._loaded.get(name)
+        if loaded is not None and loaded.mtime_ns == mtime_ns:
+            return loaded
+
+        # only one thread rebuilds a given model, the others wait and reuse it
+        with self._locks[name]:
+            loaded = self._loaded.get(name)
+            if loaded is None or loaded.mtime_ns != mtime_ns:
+                loaded = LoadedModel(self._load(path, builder), path, mtime_ns)
+                self._loaded[name] = loaded
+        return loaded
+
+    def version(self, name):
+        """Returns an identifier of the checkpoint currently served under name.
+
+        Args:
+            name (str): Name the model was registered under.
+
+        Returns:
+            str: ``path@mtime_ns`` of the loaded checkpoint.
+        """
+        return self.get(name).version
+
+    def preload(self):
+        """Loads every registered model so the first request doesn't pay for it."""
+        for name in list(self._specs):
+            self.get(name)
+
+    @staticmethod
+    def _load(path, builder):
+        """Builds a model and loads the checkpoint at path into it.
+
+        Args:
+            path (str): Path to the checkpoint file.
+            builder (callable or None): Returns a fresh ``nn.Module``, or None for TorchScript.
+
+        Returns:
+            torch.nn.Module: The loaded model in eval mode.
+        """
+        if builder is None:
+            model = torch.jit.load(path, map_location='cpu')
+        else:
+            model = builder()
+            model.load_state_dict(torch.load(path, map_location='cpu'))
+        model.eval()
+        return model
@@ -0,0 +1,122 @@
+"""LRU cache of predictions keyed by the content of the uploaded image.
+
+Entries are keyed by a SHA-256 of the raw upload bytes together with the
+identity of the checkpoint that produced them, so a repeated photo skips both
+decoding and the forward pass, and swapping the checkpoint invalidates
+everything cached for the old one.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_key(data):
+    """Returns the cache key of an uploaded file's bytes.
+
+    Args:
+        data (bytes): Raw file contents.
+
+    Returns:
+        str: Hex SHA-256 digest of the contents.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class PredictionCache(object):
+    """Thread-safe, size-bounded LRU cache with a time to live.
+
+    Args:
+        max_entries (int): Maximum number of cached predictions.
+        ttl (float): Seconds a prediction stays valid, None to never expire.
+
+    Attributes:
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that were not.
+
+    Methods:
+        get(self, key, version): Returns the cached prediction or None.
+        put(self, key, version, value): Caches a prediction.
+        clear(self): Drops every entry.
+        stats(self): Returns the hit/miss counters and current size.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        """Initializes an empty cache.
+
+        Args:
+            max_entries (int): Maximum number of cached predictions.
+            ttl (float): Seconds a prediction stays valid, None to never expire.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Returns the prediction cached for key under the given checkpoint.
+
+        Args:
+            key (str): Content key of the image, see ``content_key``.
+            version (str): Identity of the checkpoint serving the request.
+
+        Returns:
+            The cached prediction, or None on a miss.
+        """
+        with self._lock:
+            self._check_version(version)
+            key = (version, key)
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, version, value):
+        """Caches the prediction for key under the given checkpoint.
+
+        Args:
+            key (str): Content key of the image, see ``content_key``.
+            version (str): Identity of the checkpoint that made the prediction.
+            value: The prediction.
+        """
+        with self._lock:
+            self._check_version(version)
+            key = (version, key)
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit/miss counters and current size.
+
+        Returns:
+            dict: hits, misses and entries.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def _check_version(self, version):
+        """Drops every entry if the checkpoint changed since the last access.
+
+        Args:
+            version (str): Identity of the checkpoint serving the request.
+        """
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
@@ -0,0 +1,159 @@
+"""Post-training static INT8 quantization of the ingredient classifier.
+
+Takes a trained checkpoint from ``model/model_logs``, calibrates activation
+ranges on a sample of the ``Ingredients`` dataset, converts the model to INT8
+with FX graph mode quantization (which also handles the residual additions),
+and reports the accuracy of both models on a held-out sample using
+``run_test``. The quantized model is frozen and saved as TorchScript, so the
+web app serves it with ``INGREDIENT_MODEL=int8``.
+
+Usage:
+    python quantize.py path/to/ingredients model/model_logs/Ingredients8.pth model/model_logs/Ingredients8.int8.pt
+"""
+
+import argparse
+import copy
+import io
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader, Subset
+
+from dataset_maker import load_images_and_labels, Ingredients
+from inference import eval_transform, INPUT_SIZE
+from model.test import run_test
+from model_export import ARCHITECTURES
+
+
+def quantize(model, calibration_loader, backend='x86', size=INPUT_SIZE):
+    """Returns a static INT8 copy of a model calibrated on the given data.
+
+    Args:
+        model (torch.nn.Module): Trained float model, left untouched.
+        calibration_loader (torch.utils.data.DataLoader): Batches used to observe activation ranges.
+        backend (str): Quantized engine the model will run on, 'x86', 'fbgemm' or 'qnnpack'.
+        size (int): Side length of the model's input images.
+
+    Returns:
+        torch.nn.Module: Quantized model that outputs logits.
+    """
+    torch.backends.quantized.engine = backend
+    float_model = copy.deepcopy(model).eval()
+    # argmax doesn't need the sigmoid, and dropping it keeps outputs comparable to the TorchScript export
+    float_model.sigmoid = nn.Identity()
+    example_inputs = (torch.zeros(1, 3, size, size),)
+    prepared = prepare_fx(float_model, get_default_qconfig_mapping(backend), example_inputs)
+    with torch.no_grad():
+        for images, _ in calibration_loader:
+            prepared(images)
+    return convert_fx(prepared)
+
+
+def to_torchscript(model, size=INPUT_SIZE):
+    """Traces and freezes a (quantized) model.
+
+    Args:
+        model (torch.nn.Module): Model in eval mode.
+        size (int): Side length of the model's input images.
+
+    Returns:
+        torch.jit.ScriptModule: The frozen model.
+    """
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, torch.zeros(1, 3, size, size))
+        return torch.jit.freeze(scripted.eval())
+
+
+def serialized_size(model):
+    """Returns the number of bytes a model's weights take when saved.
+
+    Args:
+        model (torch.nn.Module): Model to measure.
+
+    Returns:
+        int: Size of the serialized state dict.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def calibration_split(dataset_size, calibration_size=512, test_size=1024, seed=0):
+    """Splits dataset indices into disjoint calibration and evaluation samples.
+
+    Args:
+        dataset_size (int): Number of images in the dataset.
+        calibration_size (int): Number of images used for calibration.
+        test_size (int): Number of images the accuracies are reported on.
+        seed (int): Seed of the shuffle.
+
+    Returns:
+        tuple: Calibration indices and evaluation indices.
+    """
+    indices = np.random.RandomState(seed).permutation(dataset_size)
+    calibration_idx = indices[:calibration_size]
+    test_idx = indices[calibration_size:calibration_size + test_size]
+    return calibration_idx.tolist(), test_idx.tolist()
+
+
+def run(parent_folder, checkpoint_path, output_path, arch='resnet18', backend='x86',
+        calibration_size=512, test_size=1024, batch_size=64):
+    """Quantizes a checkpoint, reports the accuracy delta and saves the INT8 model.
+
+    Args:
+        parent_folder (str): Folder of class folders, as read by ``load_images_and_labels``.
+        checkpoint_path (str): Path to the trained float state dict.
+        output_path (str): Path the quantized TorchScript model is saved to.
+        arch (str): Name of the ResNet the checkpoint belongs to.
+        backend (str): Quantized engine the model will run on.
+        calibration_size (int): Number of images used for calibration.
+        test_size (int): Number of images the accuracies are reported on.
+        batch_size (int): Batch size of the calibration and test loaders.
+
+    Returns:
+        dict: Float and INT8 accuracy and serialized size.
+    """
+    images, labels = load_images_and_labels(parent_folder)
+    dataset = Ingredients(images, labels, eval_transform())
+    calibration_idx, test_idx = calibration_split(len(dataset), calibration_size, test_size)
+    calibration_loader = DataLoader(Subset(dataset, calibration_idx), batch_size=batch_size)
+    test_loader = DataLoader(Subset(dataset, test_idx), batch_size=batch_size)
+
+    model = ARCHITECTURES[arch](len(np.unique(labels)), 3)
+    model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+    model.eval()
+    quantized = quantize(model, calibration_loader, backend)
+
+    device = torch.device('cpu')
+    report = {
+        'fp32_accuracy': run_test(model, test_loader, device),
+        'int8_accuracy': run_test(quantized, test_loader, device),
+        'fp32_bytes': serialized_size(model),
+        'int8_bytes': serialized_size(quantized),
+    }
+    report['accuracy_delta'] = report['int8_accuracy'] - report['fp32_accuracy']
+
+    torch.jit.save(to_torchscript(quantized), output_path)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Statically quantize a trained ResNet to INT8.')
+    parser.add_argument('parent_folder', help='folder of class folders used for calibration and testing')
+    parser.add_argument('checkpoint', help='path to the trained state dict')
+    parser.add_argument('output', help='path to save the quantized TorchScript model to')
+    parser.add_argument('--arch', default='resnet18', choices=sorted(ARCHITECTURES))
+    parser.add_argument('--backend', default='x86', choices=['x86', 'fbgemm', 'qnnpack'])
+    parser.add_argument('--calibration-size', type=int, default=512)
+    parser.add_argument('--test-size', type=int, default=1024)
+    args = parser.parse_args()
+    report = run(args.parent_folder, args.checkpoint, args.output, args.arch, args.backend,
+                 args.calibration_size, args.test_size)
+    print(f"fp32 accuracy {report['fp32_accuracy']:.4f}, int8 accuracy {report['int8_accuracy']:.4f} "
+          f"(delta {report['accuracy_delta']:+.4f})")
+    print(f"fp32 {report['fp32_bytes'] / 2**20:.1f} MiB, int8 {report['int8_bytes'] / 2**20:.1f} MiB "
+          f"-> {os.path.basename(args.output)}")
@@ -3,94 +3,177 @@
 Used to scrape the recipes and manipulate the recipes dataframe
 """
 
+import logging
+from concurrent.futures import as_completed
+
 import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 import requests
 
-def scrape_allRecipes_cuisines():
+from crawler import Crawler, JsonlSink, PageCache, VisitedCheckpoint
+
+logger = logging.getLogger(__name__)
+
+# URL of the page listing all cuisines on Allrecipes.com
+CUISINES_URL = 'https://www.allrecipes.com/cuisine-a-z-6740455'
+
+def parse_cuisine_index(html):
+  '''
+  - Finds the cuisine pages linked from the cuisine A-Z page
+  - Input: html of the cuisine A-Z page
+  - Output: dict of cuisine name to cuisine page URL, in page order
+  '''
+  doc = BeautifulSoup(html, "html.parser")
+  cuisine_dict = {}
+  for link in doc.select('ul.loc.mntl-link-list a'):
+    cuisine_dict[link.get_text(strip=True)] = link['href']
+  return cuisine_dict
+
+def parse_cuisine_page(html):
+  '''
+  - Finds the recipe cards of a cuisine page
+  - Input: html of a cuisine page
+  - Output: list of (recipe name, recipe URL)
+  '''
+  doc = BeautifulSoup(html, 'html.parser')
+  # {'class': 'comp mntl-card-list-items mntl-document-card mntl-card card--image-top card card--no-image'}
+  recipe_info1 = doc.find_all('a', {'class': 'comp mntl-card-list-items mntl-document-card mntl-card card card--no-image'})
+  recipe_info2 = doc.find_all('a', {'class': 'comp mntl-card-list-items mntl-document-card mntl-card card--image-top card card--no-image'})
+  recipes = []
+  for recipe_card in recipe_info1 + recipe_info2:
+    name = recipe_card.find('span', {'class': 'card__title-text'}).text.strip()
+    recipes.append((name, recipe_card.get('href')))
+  return recipes
+
+def parse_recipe_page(html):
+  '''
+  - Extracts the ingredients of a recipe page
+  - Input: html of a recipe page
+  - Output: list of "quantity unit ingredient" strings
+  '''
+  doc = BeautifulSoup(html, 'html.parser')
+  ingredients_list = []
+  ingredients_container = doc.find('div', {'class': 'mntl-lrs-ingredients'})
+  if ingredients_container:
+    ingredients_list_element = ingredients_container.find('ul', {'class': 'mntl-structured-ingredients__list'})
+    if ingredients_list_element:
+      for ingredient_item in ingredients_list_element.find_all('li', {'class': 'mntl-structured-ingredients__list-item'}):
+        ingredient = ingredient_item.find('span', {'data-ingredient-name': 'true'})
+        quantity = ingredient_item.find('span', {'data-ingredient-quantity': 'true'})
+        unit = ingredient_item.find('span', {'data-ingredient-unit': 'true'})
+
+        if ingredient and quantity and unit:
+          ingredients_list.append(f"{quantity.text.strip()} {unit.text.strip()} {ingredient.text.strip()}")
+  return ingredients_list
+
+def scrape_allRecipes_cuisines(url=CUISINES_URL, crawler=None, cache_dir=None, sink_path=None, checkpoint_path=None):
   """
   Scrapes recipe data from Allrecipes.com based on different cuisines.
 
+  The cuisine pages, then all recipe pages, are fetched concurrently through a
+  Crawler (pooled keep-alive session, per-host concurrency and rate limits,
+  retries with backoff, timeouts). A recipe listed under several cuisines is
+  fetched once. Pages that still fail after the retries are logged and skipped.
+
+  Incremental mode: with cache_dir, pages are kept on disk and refetched with
+  conditional requests, so unchanged pages cost a 304. With sink_path, every
+  recipe is appended to a JSON Lines file as soon as its page is parsed and its
+  URL is recorded in a checkpoint; rerunning with the same sink resumes an
+  interrupted crawl without refetching the recipes already written. Pages
+  that failed are never checkpointed, so a rerun tries them again.
+
+  Parameters:
+  url (str): URL of the cuisine A-Z page.
+  crawler (Crawler, optional): Crawler to fetch with, one with default limits is created and closed if None.
+  cache_dir (str, optional): Folder of the page cache of the crawler created here.
+  sink_path (str, optional): JSON Lines file the recipes are streamed to.
+  checkpoint_path (str, optional): File of visited recipe URLs, defaults to sink_path + '.visited'.
+
   Returns:
   pandas.DataFrame: DataFrame containing the scraped recipe information including Name, URL, Cuisine, and Ingredients.
   """
+  columns = ['Name', 'URL', 'Cuisine', 'Ingredients']
+  own_crawler = crawler is None
+  if own_crawler:
+    crawler = Crawler(cache=PageCache(cache_dir) if cache_dir else None)
+  sink = visited = None
+  if sink_path is not None:
+    sink = JsonlSink(sink_path)
+    visited = VisitedCheckpoint(checkpoint_path or f'{sink_path}.visited')
+  try:
+    result = crawler.fetch(url)
+    result.raise_for_status()
+    cuisine_dict = parse_cuisine_index(result.text)
 
-  # URL of the page listing all cuisines on Allrecipes.com
-  url = 'https://www.allrecipes.com/cuisine-a-z-6740455'
-  result = requests.get(url)
-  doc = BeautifulSoup(result.text, "html.parser")
-  cuisines = doc.select('ul.loc.mntl-link-list a')
+    # every cuisine page at once, then every distinct recipe page at once
+    cuisine_recipes = {}
+    for (cuisine, cuisine_url), result in zip(cuisine_dict.items(), crawler.map(list(cuisine_dict.values()))):
+      if isinstance(result, Exception) or not result.ok:
+        logger.warning(f'Skipping cuisine {cuisine}: {result if isinstance(result, Exception) else result.status_code}')
+        continue
+      cuisine_recipes[cuisine] = [(name, recipe_url) for name, recipe_url in parse_cuisine_page(result.text)
+                                  if not pd.isna(recipe_url)]
 
-  # Send a GET request to the page listing all cuisines
-  cuisine_dict = {}
-  for link in cuisines:
-      cuisine = link.get_text(strip=True)
-      url = link['href']
-      cuisine_dict[cuisine] = url
+    # cuisines and names each recipe page is listed under
+    listings = {}
+    for cuisine, recipes in cuisine_recipes.items():
+      for name, recipe_url in recipes:
+        listings.setdefault(recipe_url, []).append((cuisine, name))
 
-  # Parse the HTML content of the page
-  df = pd.DataFrame(list(cuisine_dict.items()), columns=['Cuisine', 'URL'])
+    futures = {crawler.submit(recipe_url): recipe_url for recipe_url in listings
+               if visited is None or recipe_url not in visited}
+    if visited is not None:
+      logger.info(f'{len(listings) - len(futures)} recipes already scraped, fetching {len(futures)}')
+    ingredients = {}
+    for future in as_completed(futures):
+      recipe_url = futures[future]
+      try:
+        result = future.result()
+        if not result.ok:
+          # e.g. a removed (404) or blocked (403) recipe, its page has no ingredients to parse
+          logger.warning(f'Skipping recipe {recipe_url}: {result.status_code}')
+          continue
+        ingredients[recipe_url] = parse_recipe_page(result.text)
+      except Exception as e:
+        logger.warning(f'Skipping recipe {recipe_url}: {e}')
+        continue
+      if sink is not None:
+        for cuisine, name in listings[recipe_url]:
+          sink.write({'Name': name, 'URL': recipe_url, 'Cuisine': cuisine, 'Ingredients': ingredients[recipe_url]})
+        # only after its records are written, so a crash never skips a recipe on resume;
+        # failed pages never get here, so they are retried on the next run
+        visited.add(recipe_url)
+  finally:
+    if own_crawler:
+      crawler.close()
+    if visited is not None:
+      visited.close()
+      sink.close()
 
-  # Create an empty list to store recipe information
-  recipes_data = []
+  if sink is not None:
+    records = sink.read()
+    # a crash between writing a recipe and checkpointing it can leave a duplicate
+    recipes_df = pd.DataFrame(records, columns=columns).drop_duplicates(['URL', 'Cuisine'], keep='last')
+    return recipes_df.reset_index(drop=True)
 
-  # Iterate over rows in the cuisine DataFrame
-  for index, row in df.iterrows():
-      cuisine_url = row['URL']
-      cuisine = df['Cuisine'][index]
-      result = requests.get(cuisine_url)
-      doc = BeautifulSoup(result.text, 'html.parser')
-
-      # {'class': 'comp mntl-card-list-items mntl-document-card mntl-card card--image-top card card--no-image'}
-      # Extract information for each recipe
-      recipe_info1 = doc.find_all('a', {'class': 'comp mntl-card-list-items mntl-document-card mntl-card card card--no-image'})
-      recipe_info2 = doc.find_all('a', {'class': 'comp mntl-card-list-items mntl-document-card mntl-card card--image-top card card--no-image'})
-      recipe_info = recipe_info1 + recipe_info2
-
-      # Iterate over each recipe and extract relevant information
-      for recipe_card in recipe_info:
-          name = recipe_card.find('span', {'class': 'card__title-text'}).text.strip()
-          url = recipe_card['href']
-
-          # Extract information from individual recipe URLs
-          if not pd.isna(url):
-              result2 = requests.get(url)
-              doc2 = BeautifulSoup(result2.text, 'html.parser')
-
-              # Create a list to store ingredients
-              ingredients_list = []
-              ingredients_container = doc2.find('div', {'class': 'mntl-lrs-ingredients'})
-
-              # Check if the container is found
-              if ingredients_container:
-                  # Find the list of ingredients
-                  ingredients_list_element = ingredients_container.find('ul', {'class': 'mntl-structured-ingredients__list'})
-
-                  # Check if the list of ingredients is found
-                  if ingredients_list_element:
-                      # Extract and append each ingredient to the list
-                      for ingredient_item in ingredients_list_element.find_all('li', {'class': 'mntl-structured-ingredients__list-item'}):
-                          ingredient = ingredient_item.find('span', {'data-ingredient-name': 'true'})
-                          quantity = ingredient_item.find('span', {'data-ingredient-quantity': 'true'})
-                          unit = ingredient_item.find('span', {'data-ingredient-unit': 'true'})
-
-                          if ingredient and quantity and unit:
-                              ingredient_text = f"{quantity.text.strip()} {unit.text.strip()} {ingredient.text.strip()}"
-                              ingredients_list.append(ingredient_text)
-
-              # Append recipe information to the list
-              recipes_data.append({
-                  'Name': name,
-                  'URL': url,
-                  'Cuisine': cuisine,
-                  'Ingredients': ingredients_list,
-              })
+  # Create an empty list to store recipe information, in cuisine and card order
+  recipes_data = []
+  for cuisine, recipes in cuisine_recipes.items():
+    for name, recipe_url in recipes:
+      if recipe_url in ingredients:
+        recipes_data.append({
+            'Name': name,
+            'URL': recipe_url,
+            'Cuisine': cuisine,
+            'Ingredients': ingredients[recipe_url],
+        })
 
   # Create a DataFrame from the list of recipes
-  recipes_df = pd.DataFrame(recipes_data)
+  recipes_df = pd.DataFrame(recipes_data, columns=columns)
   return recipes_df
 
+import re
 import string
 
 def remove_punctuation(text):
@@ -102,36 +185,203 @@ def remove_punctuation(text):
   translator = str.maketrans('', '', string.punctuation)
   return text.translate(translator)
 
-def find_key_ingredients(df, key_ingredients):
+# any punctuation character, a regex replaces it an order of magnitude faster than str.translate
+PUNCTUATION = re.compile('[' + re.escape(string.punctuation) + ']')
+
+# phrases that contain a key ingredient without being that ingredient,
+# a lot of recipes use corn starch and corn flour
+EXCLUSIONS = {
+    'cherries': ['cherry tomato', 'cherry jello'],
+    'corn': ['corn starch', 'corn flour'],
+    'grapes': ['grape tomato', 'grape leaves', 'grape juice'],
+    'olives': ['olive oil'],
+}
+
+# other spellings that count as a key ingredient, e.g. sometimes only one egg is needed
+VARIANTS = {
+    'eggs': ['egg'],
+}
+
+def inflections(term):
+  '''
+  - Lists the singular and plural spellings of an ingredient
+  - Input: ingredient, e.g. tomato or cherries
+  - Output: list of spellings, the ingredient itself first
+  '''
+  forms = [term]
+  if term.endswith('ies'):
+    forms.append(term[:-3] + 'y')
+  elif term.endswith('oes') or term.endswith('ches') or term.endswith('shes'):
+    forms.append(term[:-2])
+  elif term.endswith('s') and not term.endswith('ss'):
+    forms.append(term[:-1])
+  elif term.endswith('y') and term[-2:-1] not in 'aeiou':
+    forms.append(term[:-1] + 'ies')
+  elif term.endswith('o'):
+    # both are in use, e.g. tomatoes but avocados, and mangos next to mangoes
+    forms.extend([term + 's', term + 'es'])
+  elif term.endswith(('ch', 'sh', 's', 'x')):
+    forms.append(term + 'es')
+  else:
+    forms.append(term + 's')
+  return forms
+
+def _trie_pattern(phrases):
+  '''
+  - Builds a regex alternation of phrases with shared prefixes factored out, so
+    matching costs about the length of the text instead of the number of phrases
+  - Input: lowercase phrases, words separated by single spaces
+  - Output: regex source matching any of them, longest first
+  '''
+  trie = {}
+  for phrase in phrases:
+    node = trie
+    for char in phrase:
+      node = node.setdefault(char, {})
+    node[''] = True
+
+  def build(node):
+    alternatives = []
+    for char in sorted(c for c in node if c):
+      # spaces between words may be any run of whitespace in the text
+      alternatives.append((r'\s+' if char == ' ' else re.escape(char)) + build(node[char]))
+    if not alternatives:
+      return ''
+    group = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+    # the shorter phrase only matches if no longer one does
+    return f'(?:{group})?' if '' in node else group
+
+  return build(trie)
+
+class KeyIngredientMatcher:
+  '''
+  Finds key ingredients in ingredient text with one compiled regex.
+
+  The vocabulary, its declared variants and singular/plural spellings are
+  compiled once into a single prefix-factored alternation with word
+  boundaries. The alternation sits in a lookahead tried at every word start,
+  so matches may overlap: "green beans" reports green beans and beans, and
+  "sour cream cheese" both sour cream and cream cheese, like the substring
+  loop this replaces. Exclusion phrases (e.g. corn starch for corn) are part
+  of the same pattern: where one is the longest match at a word start the
+  ingredient it starts with is ignored there, other mentions still count.
+
+  Parameters:
+  vocabulary (list): key ingredients, reported in this order
+  exclusions (dict): key ingredient -> phrases that don't count as it, singular and plural with plurals
+  variants (dict): key ingredient -> other spellings that count as it
+  plurals (bool): whether singular/plural spellings of every key ingredient count as it
+
+  Methods:
+  find(self, text): Returns the key ingredients mentioned in a text
+  find_all(self, texts): Returns the key ingredients of every text of a Series
+  '''
+
+  # joins the texts of a column for one scan, neither a word character nor whitespace
+  SEPARATOR = '\x00'
+
+  def __init__(self, vocabulary, exclusions=EXCLUSIONS, variants=VARIANTS, plurals=True):
+    self.vocabulary = list(dict.fromkeys(term.lower().strip() for term in vocabulary))
+    self.order = {term: i for i, term in enumerate(self.vocabulary)}
+
+    def normalize(phrase):
+      return ' '.join(phrase.lower().split())
+
+    # spelling -> key ingredient, or None for excluded phrases; vocabulary terms
+    # take precedence over declared variants, which take precedence over plurals
+    spellings = {}
+    for term in self.vocabulary:
+      for phrase in exclusions.get(term, []):
+        # cherry tomatoes is as much not cherries as cherry tomato
+        for form in inflections(normalize(phrase)) if plurals else [normalize(phrase)]:
+          spellings[form] = None
+    for term in self.vocabulary:
+      spellings[normalize(term)] = term
+    for term in self.vocabulary:
+      for variant in variants.get(term, []):
+        spellings.setdefault(normalize(variant), term)
+    if plurals:
+      for term in self.vocabulary:
+        for form in inflections(normalize(term))[1:]:
+          spellings.setdefault(form, term)
+    self.spellings = spellings
+
+    # the regex only reports the longest spelling starting at a word, so every
+    # spelling also stands for the shorter ones it starts with (green beans -> green)
+    self.terms = {}
+    for spelling, term in spellings.items():
+      words = spelling.split(' ')
+      prefixes = (spellings.get(' '.join(words[:n])) for n in range(1, len(words) + 1))
+      self.terms[spelling] = () if term is None else tuple({t for t in prefixes if t is not None})
+    # texts are lowercased before matching, cheaper than a case-insensitive pattern
+    self.pattern = re.compile(r'\b(?=(' + _trie_pattern(spellings) + r')\b)') if spellings else None
+
+  def _terms(self, match):
+    '''
+    - Maps one matched string to the key ingredients it mentions
+    - Input: matched lowercase string, in any spacing
+    - Output: tuple of key ingredients
+    '''
+    terms = self.terms.get(match)
+    if terms is None:
+      terms = self.terms.get(' '.join(match.split()), ())
+    return terms
+
+  def _key_ingredients(self, matches):
+    '''
+    - Maps the matched spellings of one text to its key ingredients
+    - Input: list of matched strings
+    - Output: list of distinct key ingredients in vocabulary order
+    '''
+    found = {term for match in matches for term in self._terms(match)}
+    return sorted(found, key=self.order.__getitem__)
+
+  def find(self, text):
+    '''
+    - Finds the key ingredients mentioned in a text
+    - Input: ingredient text
+    - Output: list of key ingredients in vocabulary order
+    '''
+    if self.pattern is None or not isinstance(text, str):
+      return []
+    return self._key_ingredients(self.pattern.findall(text.lower()))
+
+  def find_all(self, texts):
+    '''
+    - Finds the key ingredients of every text of a column
+    - All texts are joined and scanned by one finditer, each match is mapped
+      back to its row by offset, so there is no per-row call into the regex engine
+    - Input: pandas Series of ingredient text
+    - Output: pandas Series of lists of key ingredients
+    '''
+    values = [text.lower() if isinstance(text, str) else '' for text in texts]
+    found = [set() for _ in values]
+    if self.pattern is not None and values:
+      starts = np.cumsum([0] + [len(text) + len(self.SEPARATOR) for text in values[:-1]])
+      matches = list(self.pattern.finditer(self.SEPARATOR.join(values)))
+      rows = np.searchsorted(starts, [match.start() for match in matches], side='right') - 1
+      for row, match in zip(rows.tolist(), matches):
+        found[row].update(self._terms(match.group(1)))
+    return pd.Series([sorted(terms, key=self.order.__getitem__) for terms in found], index=texts.index)
+
+def find_key_ingredients(df, key_ingredients, matcher=None):
   '''
   - Compares the lists of ingredients and creates a new column in the dataframe
     with a list of key ingredients for each recipe
-  - Input: dataframe of recipes, list of key ingredients
+  - Whole words only (plural spellings included), so e.g. pea doesn't match peanut,
+    and the rules in EXCLUSIONS and VARIANTS are applied
+  - Input: dataframe of recipes, list of key ingredients, optional prebuilt KeyIngredientMatcher
   - Output: dataframe with new column of key ingredients
   '''
+  if matcher is None:
+    matcher = KeyIngredientMatcher(key_ingredients)
 
-  # Function to check if any key ingredient is found in a list of ingredients
-  def find_word_in_string(text):
-    '''
-    - Finds key ingredients in ingredient string
-    - Input: text from ingredient column of df
-    - Output: List of key ingredients found in ingredient column
-    '''
-    R = []
-    for i in key_ingredients:
-      if i in text:
-        # a lot of recipes use corn starch and corn flour
-        if i == 'corn' and ('corn starch' in text or 'corn flour' in text):
-          break;
-        R.append(i)
-        # Sometimes only need one egg
-        if i == 'eggs' and 'egg' in text and 'eggs' not in R:
-          R.append(i)
-    return R
-
-  # Remove punctuation
-  df['Ingredients'] = df['Ingredients'].apply(remove_punctuation)
-
-  # Find key ingredients in each row
-  df['key_ingredients'] = df['Ingredients'].apply(find_word_in_string)
+  text = df['Ingredients']
+  # Remove punctuation, the same as remove_punctuation but over the whole column (missing values stay missing)
+  df['Ingredients'] = text.str.replace(PUNCTUATION, '', regex=True)
+
+  # Find key ingredients in each row, in one regex scan of the column; punctuation
+  # becomes a space there so e.g. ginger-garlic paste still mentions garlic
+  spaced = text.str.replace(PUNCTUATION, ' ', regex=True)
+  df['key_ingredients'] = matcher.find_all(spaced)
   return df
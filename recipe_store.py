@@ -0,0 +1,397 @@
+"""In-memory recipe catalogue shared by the web app.
+
+The recipes that ship with the repo are parsed once per process and indexed
+by cuisine, so a cuisine lookup is a dictionary hit instead of a download and
+a DataFrame scan. The files are re-stat'ed on access and the index is rebuilt
+only when they change. A columnar snapshot of the catalogue (see catalogue.py)
+can be prebuilt to skip CSV parsing at startup; it is read with only the
+columns the store is asked for, and the ingredient index is built from its
+integer IDs directly.
+
+Each cuisine also carries an inverted index of its key ingredients, so
+recommendations only read the posting lists of the requested ingredients
+instead of searching every recipe.
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from catalogue import parse_key_ingredients, read_catalogue, read_key_ingredient_ids, write_catalogue
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+RECIPES_CSV = os.path.join(APP_DIR, 'Recipes_cleaned.csv')
+
+# everything loaded from one version of the catalogue file
+_Catalogue = namedtuple('_Catalogue', ['path', 'stamp', 'df', 'by_cuisine', 'indexes'])
+
+
+def _runs(rows):
+    """Sorts row numbers and counts how often each occurs.
+
+    Args:
+        rows (numpy.ndarray): Integer row numbers, concatenated sorted posting lists.
+
+    Returns:
+        tuple: (distinct rows ascending, number of times each occurs).
+    """
+    if len(rows) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # the input is sorted posting lists back to back, a stable sort (timsort for these
+    # int32/int64 rows) detects those runs and only merges them
+    rows = np.sort(rows, kind='stable')
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    counts = np.diff(np.append(starts, len(rows)))
+    return rows[starts].astype(np.int64), counts
+
+
+class IngredientIndex(object):
+    """Inverted key-ingredient index over a set of recipes.
+
+    Keeps a posting list per vocabulary ingredient: the sorted rows of the
+    recipes containing it, stored back to back in one array (CSC layout).
+    A request only reads the postings of the ingredients it resolves to, so
+    its cost grows with the number of matching recipes instead of the size of
+    the catalogue, and memory grows with the number of (recipe, ingredient)
+    pairs instead of recipes x vocabulary.
+
+    Args:
+        key_ingredients (iterable): Key ingredients of each recipe, in row order.
+        vocabulary (dict, optional): Maps ingredient to column, built from the recipes if None.
+
+    Methods:
+        from_ids(cls, ids, offsets, vocabulary): Builds the index from integer-ID key ingredients.
+        take(self, rows): Returns the index restricted to the given rows.
+        resolve(self, ingredients): Maps requested ingredients onto vocabulary columns.
+        matches(self, ingredients): Returns the recipes matching any requested ingredient and their counts.
+        top_k(self, ingredients, k=None, min_matches=1): Returns the best matching recipes.
+    """
+
+    def __init__(self, key_ingredients, vocabulary=None):
+        """Builds the posting lists.
+
+        Args:
+            key_ingredients (iterable): Key ingredients of each recipe, in row order.
+            vocabulary (dict, optional): Maps ingredient to column, built from the recipes if None.
+        """
+        key_ingredients = [parse_key_ingredients(value) for value in key_ingredients]
+        if vocabulary is None:
+            vocabulary = {}
+            for recipe in key_ingredients:
+                for ingredient in recipe:
+                    vocabulary.setdefault(ingredient, len(vocabulary))
+
+        rows, cols = [], []
+        for row, recipe in enumerate(key_ingredients):
+            for ingredient in recipe:
+                if ingredient in vocabulary:
+                    rows.append(row)
+                    cols.append(vocabulary[ingredient])
+        self._build(vocabulary, len(key_ingredients), np.asarray(rows, dtype=np.int64),
+                    np.asarray(cols, dtype=np.int64), {})
+
+    @classmethod
+    def from_ids(cls, ids, offsets, vocabulary):
+        """Builds the index from key ingredients stored as integer IDs, without parsing any text.
+
+        Args:
+            ids (numpy.ndarray): Vocabulary IDs of every recipe's key ingredients, concatenated.
+            offsets (numpy.ndarray): The IDs of recipe i are ids[offsets[i]:offsets[i + 1]].
+            vocabulary (list): Ingredient name of every ID.
+
+        Returns:
+            IngredientIndex: Index over the recipes.
+        """
+        index = cls.__new__(cls)
+        num_rows = len(offsets) - 1
+        rows = np.repeat(np.arange(num_rows, dtype=np.int64), np.diff(offsets))
+        index._build({ingredient: i for i, ingredient in enumerate(vocabulary)}, num_rows, rows,
+                     np.asarray(ids, dtype=np.int64), {})
+        return index
+
+    def _build(self, vocabulary, num_rows, rows, cols, resolved):
+        """Sorts (row, column) pairs into posting lists.
+
+        Args:
+            vocabulary (dict): Maps ingredient to column.
+            num_rows (int): Number of recipes.
+            rows (numpy.ndarray): Recipe of every pair.
+            cols (numpy.ndarray): Vocabulary column of every pair.
+            resolved (dict): Cache of resolve, shared by every index over the same vocabulary.
+        """
+        self.vocabulary = vocabulary
+        self.num_rows = num_rows
+        # one key per pair orders by column, then row, and drops an ingredient listed twice
+        keys = np.unique(cols * max(num_rows, 1) + rows)
+        cols, rows = np.divmod(keys, max(num_rows, 1))
+        self.postings = rows.astype(np.int32)
+        self.indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cols, minlength=len(vocabulary)), out=self.indptr[1:])
+        self._resolved = resolved
+
+    def take(self, rows):
+        """Returns the index restricted to the given rows, sharing the vocabulary.
+
+        Args:
+            rows (numpy.ndarray): Row positions to keep, in their new order.
+
+        Returns:
+            IngredientIndex: Index over the selected recipes.
+        """
+        position = np.full(self.num_rows, -1, dtype=np.int64)
+        position[rows] = np.arange(len(rows))
+        new_rows = position[self.postings]
+        cols = np.repeat(np.arange(len(self.vocabulary), dtype=np.int64), np.diff(self.indptr))
+        keep = new_rows >= 0
+        index = IngredientIndex.__new__(IngredientIndex)
+        index._build(self.vocabulary, len(rows), new_rows[keep], cols[keep], self._resolved)
+        return index
+
+    def resolve(self, ingredients):
+        """Maps requested ingredients onto vocabulary columns.
+
+        A requested ingredient matches every key ingredient it is a substring of
+        (so "beans" also matches "green beans"), and class names such as
+        "bell_pepper" match their spaced form. Duplicates are counted once. The
+        vocabulary is scanned once per distinct ingredient; only ingredients that
+        match a column are cached, as substrings of the vocabulary they are bounded
+        by it, so arbitrary request strings never grow the cache.
+
+        Args:
+            ingredients (iterable): Requested ingredient names.
+
+        Returns:
+            list: numpy arrays of the vocabulary columns satisfying each distinct request.
+        """
+        requested = list(dict.fromkeys(ingredient.replace('_', ' ') for ingredient in ingredients))
+        columns = []
+        for ingredient in requested:
+            cols = self._resolved.get(ingredient)
+            if cols is None:
+                cols = np.array([col for name, col in self.vocabulary.items() if ingredient in name], dtype=np.int64)
+                if len(cols):
+                    self._resolved[ingredient] = cols
+            columns.append(cols)
+        return columns
+
+    def matches(self, ingredients):
+        """Returns the recipes containing at least one requested ingredient.
+
+        Only the posting lists of the requested columns are read: each request's
+        lists are merged into the set of recipes satisfying it, and the sets are
+        counted against each other.
+
+        Args:
+            ingredients (iterable): Requested ingredient names.
+
+        Returns:
+            tuple: (rows, counts) numpy arrays, rows ascending, counts the number of requests each satisfies.
+        """
+        hits = []
+        for cols in self.resolve(ingredients):
+            postings = [self.postings[self.indptr[col]:self.indptr[col + 1]] for col in cols]
+            if len(postings) == 1:
+                hits.append(postings[0])
+            elif postings:
+                # a recipe with two columns of the same request (beans, green beans) counts once
+                rows, _ = _runs(np.concatenate(postings))
+                hits.append(rows)
+        if not hits:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return _runs(np.concatenate(hits))
+
+    def top_k(self, ingredients, k=None, min_matches=1):
+        """Returns the recipes matching the most requested ingredients.
+
+        Recipes are ordered by count, then by catalogue order, so ties are
+        broken the same way whatever k is.
+
+        Args:
+            ingredients (iterable): Requested ingredient names.
+            k (int, optional): Number of recipes to return, all matches if None.
+            min_matches (int): Minimum number of matched ingredients.
+
+        Returns:
+            tuple: (rows, counts) numpy arrays ordered from most to least matching.
+        """
+        rows, counts = self.matches(ingredients)
+        keep = counts >= min_matches
+        rows, counts = rows[keep], counts[keep]
+        # rows are ascending, so a stable sort on the count keeps catalogue order among ties
+        order = np.argsort(-counts, kind='stable')[:k]
+        return rows[order], counts[order]
+
+
+class RecipeStore(object):
+    """Process-wide, cuisine-indexed view of the recipe catalogue.
+
+    Args:
+        csv_path (str): Path to the cleaned recipes CSV.
+        snapshot_path (str, optional): Path to a catalogue file (.npz) built from the
+            CSV. Used instead of the CSV whenever it is at least as new.
+        columns (iterable, optional): Columns to load, all of them if None. Cuisine is
+            always loaded, and the ingredient index is built whether or not
+            key_ingredients is among them.
+
+    Methods:
+        frame(self): Returns the full catalogue.
+        by_cuisine(self, cuisine): Returns the recipes of one cuisine.
+        recommend(self, cuisine, ingredients, k=None, min_matches=1): Returns the best matching recipes of one cuisine.
+        cuisines(self): Returns the cuisines in the catalogue.
+        build_snapshot(self): Writes the snapshot file from the CSV.
+    """
+
+    def __init__(self, csv_path=RECIPES_CSV, snapshot_path=None, columns=None):
+        """Initializes the store, the catalogue itself is loaded on first access.
+
+        Args:
+            csv_path (str): Path to the cleaned recipes CSV.
+            snapshot_path (str, optional): Path to a catalogue file built from the CSV.
+            columns (iterable, optional): Columns to load, all of them if None.
+        """
+        self.csv_path = csv_path
+        self.snapshot_path = snapshot_path
+        self.columns = None if columns is None else list(columns)
+        self._lock = threading.Lock()
+        # replaced as a whole on reload
+        self._catalogue = None
+
+    def frame(self):
+        """Returns the full catalogue.
+
+        The frame is shared between threads and must not be modified in place.
+
+        Returns:
+            pandas.DataFrame: Every recipe in the catalogue.
+        """
+        return self._refresh().df
+
+    def by_cuisine(self, cuisine):
+        """Returns the recipes of one cuisine.
+
+        The frame is shared between threads and must not be modified in place.
+
+        Args:
+            cuisine (str): Cuisine to look up.
+
+        Returns:
+            pandas.DataFrame: Recipes of that cuisine, empty if the cuisine is unknown.
+        """
+        catalogue = self._refresh()
+        cuisine_df = catalogue.by_cuisine.get(cuisine)
+        if cuisine_df is None:
+            return catalogue.df.iloc[:0]
+        return cuisine_df
+
+    def recommend(self, cuisine, ingredients, k=None, min_matches=1):
+        """Returns the recipes of a cuisine that contain the most requested ingredients.
+
+        Args:
+            cuisine (str): Cuisine to look up.
+            ingredients (iterable): Requested ingredient names.
+            k (int, optional): Number of recipes to return, all matches if None.
+            min_matches (int): Minimum number of matched ingredients.
+
+        Returns:
+            pandas.DataFrame: Matching recipes with a 'Matched Ingredients' column,
+            from most to least matching.
+        """
+        catalogue = self._refresh()
+        cuisine_df = catalogue.by_cuisine.get(cuisine)
+        if cuisine_df is None:
+            return catalogue.df.iloc[:0].assign(**{'Matched Ingredients': 0})
+        rows, counts = catalogue.indexes[cuisine].top_k(ingredients, k, min_matches)
+        recipes = cuisine_df.iloc[rows].reset_index(drop=True)
+        recipes['Matched Ingredients'] = counts
+        return recipes
+
+    def cuisines(self):
+        """Returns the cuisines in the catalogue.
+
+        Returns:
+            list: Cuisine names.
+        """
+        return list(self._refresh().by_cuisine)
+
+    def build_snapshot(self):
+        """Parses the CSV and writes every column of it to the snapshot file.
+
+        Returns:
+            str: Path of the written snapshot.
+        """
+        return write_catalogue(pd.read_csv(self.csv_path), self.snapshot_path)
+
+    def _load(self, path):
+        """Reads the catalogue and builds its ingredient index.
+
+        Args:
+            path (str): The CSV or the snapshot file.
+
+        Returns:
+            tuple: (frame with the configured columns, IngredientIndex over its rows).
+        """
+        columns = self.columns
+        if columns is not None and 'Cuisine' not in columns:
+            columns = columns + ['Cuisine']
+        if path != self.csv_path:
+            df = read_catalogue(path, columns)
+            return df, IngredientIndex.from_ids(*read_key_ingredient_ids(path))
+
+        usecols = None if columns is None else list(dict.fromkeys(columns + ['key_ingredients']))
+        df = pd.read_csv(path, usecols=usecols, dtype={'Cuisine': 'category'})
+        # same types as the snapshot gives, whichever file is newer
+        df['key_ingredients'] = df['key_ingredients'].map(parse_key_ingredients)
+        index = IngredientIndex(df['key_ingredients'])
+        if columns is not None:
+            df = df[columns]
+        return df, index
+
+    def _source(self):
+        """Returns the file the catalogue should be read from and its identity.
+
+        Returns:
+            tuple: (path, (size, mtime_ns)) of the snapshot if it is current, else of the CSV.
+        """
+        csv_stat = os.stat(self.csv_path)
+        if self.snapshot_path is not None and os.path.exists(self.snapshot_path):
+            snapshot_stat = os.stat(self.snapshot_path)
+            if snapshot_stat.st_mtime_ns >= csv_stat.st_mtime_ns:
+                return self.snapshot_path, (snapshot_stat.st_size, snapshot_stat.st_mtime_ns)
+        return self.csv_path, (csv_stat.st_size, csv_stat.st_mtime_ns)
+
+    def _refresh(self):
+        """Loads the catalogue if it has never been loaded or its file changed.
+
+        Returns:
+            _Catalogue: The current catalogue and its indexes.
+        """
+        path, stamp = self._source()
+        catalogue = self._catalogue
+        if catalogue is not None and (catalogue.path, catalogue.stamp) == (path, stamp):
+            return catalogue
+
+        with self._lock:
+            catalogue = self._catalogue
+            if catalogue is not None and (catalogue.path, catalogue.stamp) == (path, stamp):
+                return catalogue
+            df, index = self._load(path)
+            by_cuisine = {}
+            indexes = {}
+            for cuisine, rows in df.groupby('Cuisine', sort=False, observed=True).indices.items():
+                by_cuisine[cuisine] = df.iloc[rows].reset_index(drop=True)
+                indexes[cuisine] = index.take(rows)
+            # swap everything in at once so readers never see a half-built index
+            self._catalogue = _Catalogue(path, stamp, df, by_cuisine, indexes)
+            return self._catalogue
+
+
+if __name__ == '__main__':
+    '''
+    - prebuilds the snapshot next to the CSV
+    - no arguments and returns None
+    '''
+    store = RecipeStore(snapshot_path=os.path.splitext(RECIPES_CSV)[0] + '.npz')
+    print(f'Wrote {store.build_snapshot()}')
@@ -54,6 +54,9 @@ class BasicBlock(nn.Module):
                 nn.BatchNorm2d(out_channels * BasicBlock.expansion)
             )
 
+        # built once here rather than on every forward call
+        self.relu = nn.ReLU(inplace=True)
+
     def forward(self, x):
         """Forward pass of the BasicBlock.
 
@@ -63,7 +66,7 @@ class BasicBlock(nn.Module):
         Returns:
             torch.Tensor: Output tensor.
         """
-        return nn.ReLU(inplace=True)(self.residual_function(x) + self.shortcut(x))
+        return self.relu(self.residual_function(x) + self.shortcut(x))
 
 class BottleNeck(nn.Module):
     """Residual block for ResNet with more than 50 layers.
@@ -109,6 +112,8 @@ class BottleNeck(nn.Module):
                 nn.BatchNorm2d(out_channels * BottleNeck.expansion)
             )
 
+        self.relu = nn.ReLU(inplace=True)
+
     def forward(self, x):
         """Forward pass of the BottleNeck block.
 
@@ -118,7 +123,7 @@ class BottleNeck(nn.Module):
         Returns:
             torch.Tensor: Output tensor.
         """
-        return nn.ReLU(inplace=True)(self.residual_function(x) + self.shortcut(x))
+        return self.relu(self.residual_function(x) + self.shortcut(x))
 
 class ResNet(nn.Module):
     """ResNet architecture.
@@ -0,0 +1,32 @@
+import pytest
+
+from recipe_manip import KeyIngredientMatcher
+
+VOCABULARY = ['cherries', 'corn', 'eggs', 'grapes', 'green beans', 'olives', 'tomato']
+
+
+@pytest.fixture(scope='module')
+def matcher():
+    return KeyIngredientMatcher(VOCABULARY)
+
+
+@pytest.mark.parametrize('text, expected', [
+    # the substring loop never tagged these as the fruit, only as tomato
+    ('2 cups cherry tomatoes halved', ['tomato']),
+    ('1 cherry tomato', ['tomato']),
+    ('1 pint grape tomatoes', ['tomato']),
+    ('1 cup grape tomato halves', ['tomato']),
+    ('1 jar grape leaves drained', []),
+    ('1 cup grape juice', []),
+    ('1 package cherry jello', []),
+    # other mentions of the fruit still count
+    ('cherry tomatoes and 1 cup fresh cherries', ['cherries', 'tomato']),
+    ('2 cups seedless grapes', ['grapes']),
+    ('1 cup corn starch 2 ears corn', ['corn']),
+    ('1 cup corn starch', []),
+    ('2 tablespoons olive oil', []),
+    ('1 egg', ['eggs']),
+    ('green beans', ['green beans']),
+])
+def test_find(matcher, text, expected):
+    assert matcher.find(text) == expected